@@ -14,39 +14,122 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import time #For working out when the blackout period starts and ends
+startTime = time.time() #For the startup timing report
 import xbmc #For most of what we do through Kodi
 import xbmcaddon #So we can get user-changable settings
 import xbmcgui #So we can show notification
+import threading #So callbacks from different Kodi threads don't interleave lighting changes
+import re #For reading the LightFader banner
+import select #For noticing when the serial port hangs up
+import errno #For telling an interrupted wait from a failed one
+import os #For checking whether the serial device is plugged in
+import sys #For finding the included libraries
+import json #For the status file
+import bisect #For sorting timings into histogram buckets
+import math #For the fade curves of streamed frames
+from functools import wraps #For timing callbacks
+from collections import namedtuple, OrderedDict #For the settings snapshot and the pending command queue
 
 #Program information values
-__addonname__ = xbmcaddon.Addon().getAddonInfo("name")
-__version__ = xbmcaddon.Addon().getAddonInfo("version")
-__author__ = xbmcaddon.Addon().getAddonInfo("author")
-__addon_id__ = xbmcaddon.Addon().getAddonInfo("id")
+settings = xbmcaddon.Addon() #The one Addon object, for information and settings
+__addonname__ = settings.getAddonInfo("name")
+__version__ = settings.getAddonInfo("version")
+__author__ = settings.getAddonInfo("author")
+__addon_id__ = settings.getAddonInfo("id")
 
 def showNotification(header, message, time=4000, icon=xbmcgui.NOTIFICATION_INFO):
 	"""Show a notification dialog"""
 	xbmcgui.Dialog().notification(header, message, icon, time)
 
-def addLogEntry(entry, loglevel=xbmc.LOGNOTICE):
-	"""Add a log entry to the Kodi log"""
+LOG_REPEAT_INTERVAL = 60 #Seconds during which the same warning or error is only logged once
+minLogLevel = xbmc.LOGNOTICE #Lowest level Kodi is writing to its log (see refreshLogLevel)
+MAX_REPEATED_LOG_ENTRIES = 100 #Messages remembered for LOG_REPEAT_INTERVAL before the ones that have expired are forgotten
+repeatedLogEntries = {} #warning or error message (with its args filled in) -> [time last logged, times left out since]
+
+def refreshLogLevel():
+	"""Check whether Kodi's debug logging is on, so debug entries can be skipped without building them when it isn't"""
+	global minLogLevel
+	if xbmc.getCondVisibility("System.GetBool(debug.showloginfo)"):
+		minLogLevel = xbmc.LOGDEBUG
+	else:
+		minLogLevel = xbmc.LOGNOTICE #Kodi only writes notices and above without debug logging
+
+def logEnabled(loglevel):
+	"""Check whether an entry at a log level would be written (for entries that take work to put together)"""
+	return loglevel >= minLogLevel
+
+def addLogEntry(entry, loglevel=xbmc.LOGNOTICE, *args):
+	"""Add a log entry to the Kodi log. Any args are filled into entry with % only if the entry is going to be written.
+	The same warning or error is only logged once every LOG_REPEAT_INTERVAL seconds.
+	"""
+	if loglevel < minLogLevel:
+		return
+	if args:
+		entry = entry % args
+	if loglevel >= xbmc.LOGWARNING:
+		now = time.time()
+		repeated = repeatedLogEntries.get(entry)
+		if (repeated is not None) and (now - repeated[0] < LOG_REPEAT_INTERVAL):
+			repeated[1] += 1
+			return
+		if (repeated is None) and (len(repeatedLogEntries) >= MAX_REPEATED_LOG_ENTRIES):
+			for message, (logged, leftout) in list(repeatedLogEntries.items()):
+				if now - logged >= LOG_REPEAT_INTERVAL:
+					repeatedLogEntries.pop(message, None) #another thread may have got to it first
+		repeatedLogEntries[entry] = [now, 0]
+		if repeated is not None and repeated[1]:
+			entry += " (repeated %d times since it was last logged)" % repeated[1]
 	xbmc.log(__addonname__ + ": " + entry, loglevel)
 
-#Import a serial library from somewhere
-try:
-	#try to use the default pyserial
-	import serial
-except:
-	addLogEntry("Default serial library not found, attempting to use included version", xbmc.LOGWARNING)
+refreshLogLevel()
+
+startupTimes = OrderedDict() #stage -> seconds after the add-on started that it was done
+startupReported = False
+
+def markStartup(stage):
+	"""Record when a stage of starting up finished; once the first scene is on its way to the lights, log how long each took"""
+	global startupReported
+	if stage in startupTimes:
+		return
+	startupTimes[stage] = time.time() - startTime
+	if stage == "first scene" and not startupReported:
+		startupReported = True
+		addLogEntry("Startup: %s", xbmc.LOGNOTICE, ", ".join(["%s %d ms" % (name, seconds * 1000) for name, seconds in startupTimes.items()]))
+
+markStartup("imports")
+
+serial = None #The serial library, imported the first time a port is opened (see loadSerial)
+serialLoadReported = False #whether the user has been told the serial library couldn't be loaded
+libPath = os.path.join(xbmc.translatePath(settings.getAddonInfo('path')), 'resources', 'lib')
+if libPath not in sys.path:
+	sys.path.append(libPath) #at the end, so an installed pyserial is still used ahead of the included one
+from lightfader import curves, tables #The LightFader sketch's fade math, to work out where a light is part way through a fade
+
+def loadSerial():
+	"""Import a serial library from somewhere the first time it's needed, since it also loads the platform's serial code"""
+	global serial, serialLoadReported
+	if serial is not None:
+		return serial
 	try:
-		import os
-		import sys
-		sys.path.append(os.path.join(xbmc.translatePath(xbmcaddon.Addon().getAddonInfo('path')) , 'resources', 'lib' ) )
-		import serial
-	except:
-		showNotification(__addonname__, "Unable to load serial library", icon=xbmcgui.NOTIFICATION_ERROR)
-		addLogEntry("Unable to load any serial library, sorry", xbmc.LOGFATAL)
-		exit()
+		#the default pyserial if there is one, otherwise the included version
+		import serial as serialLibrary
+	except ImportError as e:
+		if not serialLoadReported:
+			#the connection supervisor keeps retrying, so only tell the user the first time
+			serialLoadReported = True
+			showNotification(__addonname__, "Unable to load serial library", icon=xbmcgui.NOTIFICATION_ERROR)
+			addLogEntry("Unable to load any serial library, sorry: %s", xbmc.LOGFATAL, e)
+		else:
+			addLogEntry("Still unable to load a serial library: %s", xbmc.LOGERROR, e)
+		raise
+	if os.path.abspath(serialLibrary.__file__).startswith(os.path.abspath(libPath)):
+		addLogEntry("Default serial library not found, using included version", xbmc.LOGDEBUG)
+	#Let the serial port setting be lightfader:// to use the included LightFader emulator instead of an Arduino
+	if hasattr(serialLibrary, "protocol_handler_packages"):
+		serialLibrary.protocol_handler_packages.append("lightfader")
+	serial = serialLibrary
+	return serial
 
 #Lighting modes
 MODE_NORMAL = 0
@@ -54,206 +137,1370 @@ MODE_PLAYING = 1
 MODE_PAUSED = 2
 MODE_SCREENSAVER = 3
 modeNames = ["Idle", "Playing", "Paused", "Screensaver"]
+modeLevelFields = ["normal", "play", "pause", "ss"] #ZoneConfig field holding each mode's brightness
+fadeCommandNames = {curves.FADE_LINEAR: "linear", curves.FADE_EXPONENTIAL: "exponential", curves.FADE_LOGARITHMIC: "logarithmic"}
+
+#Where fades are worked out (the fadeoutput setting)
+FADE_OUTPUT_ARDUINO = 0 #fade commands, stepped by the Arduino
+FADE_OUTPUT_FRAMES = 1 #set commands streamed at the frame rate by FrameStreamer
+
+#Curves for streamed frames (the fadecurve setting)
+CURVE_ARDUINO = 0 #exponential up and logarithmic down, the same as the Arduino does them
+CURVE_LINEAR = 1
+CURVE_SCURVE = 2 #smoothstep: starts and ends gently
+CURVE_SINE = 3 #half a cosine wave: eases in and out a little more gently still
+easingFunctions = {
+	CURVE_LINEAR: lambda progress: progress,
+	CURVE_SCURVE: lambda progress: progress * progress * (3 - 2 * progress),
+	CURVE_SINE: lambda progress: 0.5 - 0.5 * math.cos(math.pi * progress)
+}
+
+#How a brightness percentage becomes a PWM level (the <zone>brightnesscurve settings)
+BRIGHTNESS_LINEAR = 0 #PWM duty cycle in proportion to the percentage
+BRIGHTNESS_GAMMA = 1 #gamma 2.2, roughly how bright the eye sees a duty cycle to be
+BRIGHTNESS_CIE = 2 #CIE 1931 lightness (L*), evenly spaced steps of perceived brightness
+luminanceFunctions = { #lightness from 0 to 1 -> fraction of full duty cycle
+	BRIGHTNESS_LINEAR: lambda lightness: lightness,
+	BRIGHTNESS_GAMMA: lambda lightness: lightness ** 2.2,
+	BRIGHTNESS_CIE: lambda lightness: (lightness * 100 / 903.3) if lightness <= 0.08 else ((lightness * 100 + 16) / 116.0) ** 3
+}
+
+#Lighting zones
+ZONES = ["house", "aisle", "ambient"]
+
+#Settings snapshot types; these are rebuilt as a whole whenever the settings change and never modified in place
+ZoneConfig = namedtuple("ZoneConfig", ["control", "channel", "normal", "play", "pause", "ss", "blackout", "brightnesscurve"])
+Config = namedtuple("Config", ["serialport", "baudrate", "lightsoffonexit", "dimonpause", "dimonscreensaver", "fadeduration", "settletime", "streamframes", "framerate", "fadecurve", "statusport", "startblackouttime", "endblackouttime"] + ZONES)
+
+#Precomputed lighting scenes built from a Config:
+#  channels     the channel of each controlled zone
+#  levels       for each lighting state, the PWM level (0-255) of each controlled zone (in the same order as channels)
+#  transitions  for each pair of lighting states, the (channel, startlevel, endlevel) fades needed to go from one to the other
+#  brightness   channel -> BrightnessTable for its zone
+#Lighting states are indexed with sceneState()
+SceneTable = namedtuple("SceneTable", ["channels", "levels", "transitions", "brightness"])
+
+#Lookup tables for one of the brightness curves:
+#  percent    PWM level for each brightness percentage (101 entries)
+#  pwm        PWM level for each of 256 evenly spaced steps of lightness
+#  lightness  the lightness step (0-255) of each PWM level, the inverse of pwm
+BrightnessTable = namedtuple("BrightnessTable", ["percent", "pwm", "lightness"])
+
+#What a channel was last told to do: the PWM level it's going to, and the fade (if any) that's getting it there
+ChannelState = namedtuple("ChannelState", ["level", "startlevel", "starttime", "duration", "curve", "brightness"])
 
 #Global objects and variables
-settings = xbmcaddon.Addon()
-serialPort = serial.Serial()
+def makeSerialPort(port=None):
+	"""Create a (closed) serial port for a device name or a pyserial URL such as lightfader://"""
+	loadSerial()
+	if (port is not None) and ("://" in port):
+		newPort = serial.serial_for_url(port, do_not_open=True)
+	else:
+		newPort = serial.Serial()
+		newPort.setPort(port)
+	if hasattr(newPort, "setHupcl"):
+		newPort.setHupcl(False) #Keep DTR up when the port is closed so opening it again doesn't reset the Arduino
+	return newPort
+
+def clearHupcl(port):
+	"""Clear the HUPCL (hang up on close) flag of an open serial port with termios, for serial libraries without setHupcl
+	(e.g. an installed pyserial 3), so DTR stays up when it's closed and opening it again doesn't reset the Arduino
+	"""
+	try:
+		import termios
+		fd = port.fileno()
+		attributes = termios.tcgetattr(fd)
+		if attributes[2] & termios.HUPCL:
+			attributes[2] &= ~termios.HUPCL
+			termios.tcsetattr(fd, termios.TCSANOW, attributes)
+	except Exception as e:
+		addLogEntry("Unable to keep DTR up when the serial port is closed, so the Arduino will reset when it's reopened: %s", xbmc.LOGDEBUG, e)
+
+def portIsOpen():
+	"""Check whether the serial port is open"""
+	return (serialPort is not None) and serialPort.isOpen()
+
+serialPort = None #Created when it's first opened
 currentMode = MODE_NORMAL
 blackedOut = False
+shownScene = 0 #Scene table index of the scene the lights were last sent to (currentMode and blackedOut can be ahead of it during the settle time)
+stateLock = threading.RLock()
+portLock = threading.Lock() #Held while writing to, opening or closing the serial port
+WRITE_TIMEOUT = 1 #Seconds to wait on a stalled serial port before giving up on a write
+BANNER_TIMEOUT = 2.5 #Seconds to wait for the Arduino to announce itself after it resets, for firmware that doesn't
+RECONNECT_MIN_DELAY = 0.5 #Seconds to wait before the first attempt at reopening a failed serial port
+RECONNECT_MAX_DELAY = 30 #Longest to wait between attempts at reopening a failed serial port, in seconds
+LIST_TIMEOUT = 0.1 #Seconds to wait for the next line of the Arduino's reply to a list command
+bannerPattern = re.compile(r"LightFader version ([0-9.]+)") #Printed by LightFader's setup(), e.g. "LightFader version 1.1.2 (Oct 17 2015)"
+usbPattern = re.compile(r"VID:PID=([0-9A-Fa-f]+):([0-9A-Fa-f]+)(?: (?:SNR|SER)=(\S+))?") #Hardware ID from serial.tools.list_ports, e.g. "USB VID:PID=2341:0043 SNR=12345" (pyserial 3 says SER= instead)
+channelPattern = re.compile(r"Channel ([0-9]+) \(pin [0-9]+\) = ([0-9]+)") #Printed by LightFader for get and list, e.g. "Channel 0 (pin 3) = 255"
+firmwareVersion = None #Version of the LightFader firmware as a tuple of ints, if it has told us
+portSettings = None #(port, baudrate) settings the serial port was last opened for
+MAX_PENDING_COMMANDS = 32 #Most commands the serial writer will hold before dropping the oldest
+BURST_SETTLE_TIME = 0.25 #Seconds to hold the change from the end of playback, in case the next playlist item starts
+BLACKOUT_RECHECK = 300 #Longest to sleep between blackout checks, in seconds, in case the clock changes
+STATUS_INTERVAL = 10 #Seconds between updates of the status file
+STATUS_FILE = "status.json" #Name of the status file in the add-on's profile folder
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000) #Upper bounds of the timing histogram buckets, in milliseconds
+
+def getBoolSetting(name):
+	"""Gets a boolean setting"""
+	return settings.getSetting(name) == "true"
+
+def getIntSetting(name, default=0):
+	"""Gets an integer setting (sliders and numbers), falling back to a default if it can't be parsed"""
+	try:
+		return int(float(settings.getSetting(name)))
+	except ValueError:
+		addLogEntry("Invalid value for setting %s, using %s", xbmc.LOGWARNING, name, default)
+		return default
+
+def getTimeSetting(name):
+	"""Gets a time setting (HH:MM) as minutes after midnight, or None if it can't be parsed"""
+	try:
+		hours, minutes = settings.getSetting(name).split(":")
+		return (int(hours) % 24) * 60 + int(minutes)
+	except ValueError:
+		addLogEntry("Invalid value for setting %s", xbmc.LOGWARNING, name)
+		return None
+
+def getFloatSetting(name, default=0.0):
+	"""Gets a floating point setting, falling back to a default if it can't be parsed"""
+	try:
+		return float(settings.getSetting(name))
+	except ValueError:
+		addLogEntry("Invalid value for setting %s, using %s", xbmc.LOGWARNING, name, default)
+		return default
+
+def loadZoneConfig(zone):
+	"""Reads the settings for a single lighting zone"""
+	return ZoneConfig(
+		control = getBoolSetting("control" + zone + "lighting"),
+		channel = getIntSetting(zone + "lightingchannel"),
+		normal = getIntSetting("normal" + zone + "brightness"),
+		play = getIntSetting("play" + zone + "brightness"),
+		pause = getIntSetting("pause" + zone + "brightness"),
+		ss = getIntSetting("ss" + zone + "brightness"),
+		blackout = getBoolSetting("blackout" + zone),
+		brightnesscurve = getIntSetting(zone + "brightnesscurve", BRIGHTNESS_LINEAR)
+	)
+
+def loadConfig():
+	"""Reads all of the settings from Kodi at once into an immutable snapshot"""
+	return Config(
+		serialport = settings.getSetting("serialport"),
+		baudrate = getIntSetting("baudrate", 57600),
+		lightsoffonexit = getBoolSetting("lightsoffonexit"),
+		dimonpause = getBoolSetting("dimonpause"),
+		dimonscreensaver = getBoolSetting("dimonscreensaver"),
+		fadeduration = int(getFloatSetting("fadeduration", 2.0) * 1000),
+		settletime = getIntSetting("settletime", 50),
+		streamframes = getIntSetting("fadeoutput", FADE_OUTPUT_ARDUINO) == FADE_OUTPUT_FRAMES,
+		framerate = max(getIntSetting("framerate", 50), 1),
+		fadecurve = getIntSetting("fadecurve", CURVE_ARDUINO),
+		statusport = getIntSetting("statusport", 0),
+		startblackouttime = getTimeSetting("startblackouttime"),
+		endblackouttime = getTimeSetting("endblackouttime"),
+		house = loadZoneConfig("house"),
+		aisle = loadZoneConfig("aisle"),
+		ambient = loadZoneConfig("ambient")
+	)
+
+def fadeMode(startlevel, endlevel):
+	"""Gets the curve used to fade between two PWM levels (one of the curves.FADE_ modes)"""
+	if endlevel > startlevel:
+		return curves.FADE_EXPONENTIAL
+	return curves.FADE_LOGARITHMIC
+
+def curveLevel(curve, startlevel, endlevel, duration, elapsed, brightness=None):
+	"""Gets the level elapsed milliseconds into a fade along one of the CURVE_ curves.
+	With a BrightnessTable the easing curves move evenly through perceived brightness rather than duty cycle.
+	"""
+	easing = easingFunctions.get(curve)
+	if easing is None:
+		return tables.fadeLevel(fadeMode(startlevel, endlevel), startlevel, endlevel, duration, elapsed)
+	if elapsed >= duration:
+		return endlevel
+	progress = easing(max(elapsed, 0) / float(duration))
+	if brightness is None:
+		return int(round(startlevel + (endlevel - startlevel) * progress))
+	startstep = brightness.lightness[startlevel]
+	return brightness.pwm[int(round(startstep + (brightness.lightness[endlevel] - startstep) * progress))]
+
+def levelToPWM(level):
+	"""Converts a brightness percentage to a PWM value"""
+	return int(2.55 * level)
+
+def buildBrightnessTable(brightnesscurve):
+	"""Works out the lookup tables for one of the BRIGHTNESS_ curves"""
+	if brightnesscurve == BRIGHTNESS_LINEAR:
+		return BrightnessTable(tuple([levelToPWM(level) for level in range(101)]), tuple(range(256)), tuple(range(256)))
+	luminance = luminanceFunctions.get(brightnesscurve, luminanceFunctions[BRIGHTNESS_LINEAR])
+	percent = tuple([int(round(255 * luminance(level / 100.0))) for level in range(101)])
+	pwm = tuple([int(round(255 * luminance(step / 255.0))) for step in range(256)])
+	lightness = tuple([min(bisect.bisect_left(pwm, level), 255) for level in range(256)])
+	return BrightnessTable(percent, pwm, lightness)
+
+def percentToPWM(brightness, level):
+	"""Converts a brightness percentage to a PWM value with a zone's BrightnessTable"""
+	return brightness.percent[max(0, min(100, level))]
+
+def sceneState(mode, blackout):
+	"""Gets the index of a lighting state in the scene table"""
+	if blackout:
+		return mode * 2 + 1
+	return mode * 2
+
+def buildSceneTable(cfg):
+	"""Works out the level of every controlled zone in every lighting state, and the fades between every pair of states"""
+	zones = [zoneconfig for zoneconfig in [getattr(cfg, zone) for zone in ZONES] if zoneconfig.control]
+	channels = tuple([zoneconfig.channel for zoneconfig in zones])
+	brightnesstables = {}
+	for zoneconfig in zones:
+		if zoneconfig.brightnesscurve not in brightnesstables:
+			brightnesstables[zoneconfig.brightnesscurve] = buildBrightnessTable(zoneconfig.brightnesscurve)
+	zonebrightness = [brightnesstables[zoneconfig.brightnesscurve] for zoneconfig in zones]
+	levels = []
+	for mode in range(len(modeNames)):
+		for blackout in (False, True):
+			row = []
+			for zoneconfig, brightness in zip(zones, zonebrightness):
+				if blackout and zoneconfig.blackout:
+					row.append(0)
+				else:
+					row.append(percentToPWM(brightness, getattr(zoneconfig, modeLevelFields[mode])))
+			levels.append(tuple(row))
+	transitions = []
+	for fromlevels in levels:
+		transitions.append([tuple([(channel, startlevel, endlevel) for channel, startlevel, endlevel in zip(channels, fromlevels, tolevels) if startlevel != endlevel]) for tolevels in levels])
+	return SceneTable(channels, levels, transitions, dict(zip(channels, zonebrightness)))
+
+class ChannelTracker(object):
+	"""Keeps track of the level each channel was last told to go to and any fade still in progress,
+	so fades can start from where the light actually is and commands that wouldn't change anything can be skipped.
+	"""
+	def __init__(self):
+		"""Initializes the tracker with no channels known"""
+		self.channels = {}
+		self.defaultlevel = None #level of channels with no state of their own
+
+	def reset(self, level=0):
+		"""Record that every channel has been set to the same level (e.g. by an Arduino reset or alloff)"""
+		for channel in self.channels:
+			self.channels[channel] = ChannelState(level, level, 0, 0, None, None)
+		self.defaultlevel = level
+
+	def levelAt(self, channel, now=None):
+		"""Get the level of a channel at a given time (default now), or None if it isn't known.
+		Levels part way through a fade come from the same curve the Arduino (or FrameStreamer) is stepping the light along.
+		"""
+		state = self.channels.get(channel)
+		if state is None:
+			return self.defaultlevel
+		if now is None:
+			now = time.time()
+		elapsed = (now - state.starttime) * 1000
+		if elapsed >= state.duration:
+			return state.level
+		if state.curve is not None:
+			return curveLevel(state.curve, state.startlevel, state.level, state.duration, elapsed, state.brightness)
+		return tables.fadeLevel(fadeMode(state.startlevel, state.level), state.startlevel, state.level, state.duration, elapsed)
+
+	def fade(self, channel, endlevel, duration, now=None, curve=None, brightness=None):
+		"""Record a fade of a channel to a new level, returning the level it starts from (None if the channel is already there).
+		If the start level is the same as the end level the fade is recorded with no duration, and a set should be sent instead.
+		curve is one of the CURVE_ values for a fade streamed from here, or None for one the Arduino runs,
+		and brightness the channel's BrightnessTable for streamed fades to follow.
+		"""
+		if now is None:
+			now = time.time()
+		startlevel = self.levelAt(channel, now)
+		state = self.channels.get(channel)
+		if (startlevel == endlevel) and ((state is None) or (state.level == endlevel)):
+			return None
+		if startlevel is None:
+			startlevel = 0
+		if startlevel == endlevel:
+			duration = 0
+			curve = None
+		self.channels[channel] = ChannelState(endlevel, startlevel, now, duration, curve, brightness)
+		return startlevel
+
+	def set(self, channel, level):
+		"""Record a channel being set straight to a level, returning False if it's already there"""
+		state = self.channels.get(channel)
+		if (state is not None) and (state.level == level) and (self.levelAt(channel) == level):
+			return False
+		self.channels[channel] = ChannelState(level, level, 0, 0, None, None)
+		return True
 
-def sendCommand(command):
-	"""Sends the given command over the serial port (appends a newline character to the command)"""
-	addLogEntry("Sending command '" + command + "'", xbmc.LOGDEBUG)
-	if serialPort.isOpen():
+	def streamed(self):
+		"""Get the (channel, state) of every channel whose last fade was streamed from here"""
+		return [(channel, state) for channel, state in self.channels.items() if state.curve is not None]
+
+config = loadConfig()
+scenes = buildSceneTable(config)
+channelTracker = ChannelTracker()
+markStartup("settings")
+
+class Histogram(object):
+	"""Counts timings in fixed buckets (see LATENCY_BUCKETS), plus one for anything longer"""
+	def __init__(self, bounds=LATENCY_BUCKETS):
+		"""Initializes an empty histogram"""
+		self.bounds = bounds
+		self.counts = [0] * (len(bounds) + 1)
+		self.count = 0
+		self.total = 0.0
+		self.maximum = 0.0
+
+	def record(self, seconds):
+		"""Adds one timing"""
+		milliseconds = seconds * 1000
+		self.counts[bisect.bisect_left(self.bounds, milliseconds)] += 1
+		self.count += 1
+		self.total += milliseconds
+		if milliseconds > self.maximum:
+			self.maximum = milliseconds
+
+	def snapshot(self):
+		"""Gets the histogram as a dict for the status file"""
+		return {
+			"count": self.count,
+			"mean_ms": (self.total / self.count) if self.count else 0,
+			"max_ms": self.maximum,
+			"buckets": [[bound, count] for bound, count in zip(list(self.bounds) + ["+Inf"], self.counts)]
+		}
+
+class Statistics(object):
+	"""Counters and timing histograms for the status file and page. Updating them is cheap and never waits on I/O."""
+	def __init__(self):
+		"""Initializes all of the counters to zero"""
+		self.lock = threading.Lock()
+		self.starttime = time.time()
+		self.events = {} #callback name -> times called
+		self.callbacktimes = {} #callback name -> Histogram of how long it took
+		self.channelcommands = {} #channel -> commands queued for it
+		self.commandsqueued = 0
+		self.commandsdropped = 0
+		self.commandswritten = 0
+		self.writes = 0
+		self.byteswritten = 0
+		self.writeerrors = 0
+		self.reconnects = 0
+		self.scenechanges = 0
+		self.frames = 0
+		self.framecommands = 0
+		self.framecommandsdeferred = 0
+		self.scenescoalesced = 0
+		self.queuedepth = 0
+		self.maxqueuedepth = 0
+		self.writetimes = Histogram()
+
+	def countCallback(self, name, seconds):
+		"""Records a Kodi callback and how long it took"""
+		with self.lock:
+			self.events[name] = self.events.get(name, 0) + 1
+			histogram = self.callbacktimes.get(name)
+			if histogram is None:
+				histogram = self.callbacktimes[name] = Histogram()
+			histogram.record(seconds)
+
+	def countQueued(self, keys, depth, dropped):
+		"""Records commands being queued for the given channels (or other keys), and how many are now waiting"""
+		with self.lock:
+			for key in keys:
+				self.channelcommands[key] = self.channelcommands.get(key, 0) + 1
+			self.commandsqueued += len(keys)
+			self.commandsdropped += dropped
+			self.queuedepth = depth
+			if depth > self.maxqueuedepth:
+				self.maxqueuedepth = depth
+
+	def countWrite(self, commands, size, seconds):
+		"""Records a write to the serial port"""
+		with self.lock:
+			self.queuedepth = 0
+			self.commandswritten += commands
+			self.writes += 1
+			self.byteswritten += size
+			self.writetimes.record(seconds)
+
+	def countWriteError(self):
+		"""Records a failed write"""
+		with self.lock:
+			self.writeerrors += 1
+
+	def countReconnect(self):
+		"""Records the serial port being reopened after it failed"""
+		with self.lock:
+			self.reconnects += 1
+
+	def countSceneChange(self, coalesced):
+		"""Records a change of scene being shown, and how many earlier changes waiting in the settle time it replaced"""
+		with self.lock:
+			self.scenechanges += 1
+			self.scenescoalesced += coalesced
+
+	def countFrame(self, commands, deferred):
+		"""Records a frame streamed for host-side fades, and how many channels had to wait for the next one"""
+		with self.lock:
+			self.frames += 1
+			self.framecommands += commands
+			self.framecommandsdeferred += deferred
+
+	def snapshot(self):
+		"""Gets all of the counters as a dict for the status file"""
+		with self.lock:
+			return {
+				"uptime": time.time() - self.starttime,
+				"events": dict(self.events),
+				"callback_times": dict([(name, histogram.snapshot()) for name, histogram in self.callbacktimes.items()]),
+				"channel_commands": dict([(str(key), count) for key, count in self.channelcommands.items()]),
+				"commands_queued": self.commandsqueued,
+				"commands_dropped": self.commandsdropped,
+				"commands_written": self.commandswritten,
+				"writes": self.writes,
+				"bytes_written": self.byteswritten,
+				"write_errors": self.writeerrors,
+				"reconnects": self.reconnects,
+				"scene_changes": self.scenechanges,
+				"scene_changes_coalesced": self.scenescoalesced,
+				"frames": self.frames,
+				"frame_commands": self.framecommands,
+				"frame_commands_deferred": self.framecommandsdeferred,
+				"queue_depth": self.queuedepth,
+				"max_queue_depth": self.maxqueuedepth,
+				"write_times": self.writetimes.snapshot()
+			}
+
+statistics = Statistics()
+
+def timedCallback(function):
+	"""Decorator for Kodi callbacks that counts and times each call"""
+	name = function.__name__
+	@wraps(function)
+	def timed(*args):
+		starttime = time.time()
+		try:
+			return function(*args)
+		finally:
+			statistics.countCallback(name, time.time() - starttime)
+	return timed
+
+def writeCommands(commands):
+	"""Writes a group of commands to the serial port in a single write (appends a newline character to each command)"""
+	if logEnabled(xbmc.LOGDEBUG):
+		addLogEntry("Sending command '%s'", xbmc.LOGDEBUG, "', '".join(commands))
+	with portLock:
+		if portIsOpen():
+			data = "\n".join(commands) + "\n"
+			starttime = time.time()
+			try:
+				serialPort.write(data)
+			except Exception as e:
+				statistics.countWriteError()
+				addLogEntry("Error writing to serial port: %s", xbmc.LOGERROR, e)
+				supervisor.connectionLost()
+			else:
+				statistics.countWrite(len(commands), len(data), time.time() - starttime)
+				markStartup("first scene")
+		else:
+			addLogEntry("Tried to write to closed serial port", xbmc.LOGWARNING)
+
+class SerialWriter(threading.Thread):
+	"""Background thread that does all of the writing to the serial port so Kodi's callbacks never wait on it.
+	Commands waiting to be sent are keyed by channel, so a newer command for a channel replaces one that hasn't gone out yet.
+	"""
+	def __init__(self, maxpending=MAX_PENDING_COMMANDS):
+		"""Initializes the writer; call start() to begin sending"""
+		threading.Thread.__init__(self, name="SerialWriter")
+		self.daemon = True
+		self.maxpending = maxpending
+		self.pending = OrderedDict() #key -> command, oldest first
+		self.condition = threading.Condition()
+		self.running = True
+		self.paused = False
+		self.writing = False
+
+	def submit(self, commands, clearpending=False):
+		"""Queues (key, command) pairs for sending; clearpending drops everything not yet sent first (e.g. for alloff)"""
+		with self.condition:
+			if clearpending:
+				self.pending.clear()
+			for key, command in commands:
+				#Re-inserting moves the key to the end so commands still go out in the order they were last submitted
+				self.pending.pop(key, None)
+				self.pending[key] = command
+			dropped = 0
+			while len(self.pending) > self.maxpending:
+				key, command = self.pending.popitem(False)
+				dropped += 1
+				addLogEntry("Serial writer is backed up, dropped command '%s'", xbmc.LOGWARNING, command)
+			statistics.countQueued([key for key, command in commands], len(self.pending), dropped)
+			self.condition.notify()
+
+	def clear(self):
+		"""Drops everything that hasn't been sent yet"""
+		with self.condition:
+			self.pending.clear()
+
+	def pause(self):
+		"""Holds on to queued commands (still keeping only the newest per channel) until resume() is called"""
+		with self.condition:
+			self.paused = True
+
+	def resume(self):
+		"""Starts sending queued commands again after pause()"""
+		with self.condition:
+			self.paused = False
+			self.condition.notify()
+
+	def flush(self, timeout=WRITE_TIMEOUT * 2):
+		"""Waits (up to timeout seconds) until everything queued so far has been written"""
+		with self.condition:
+			if self.paused:
+				return not (self.pending or self.writing)
+			if self.pending or self.writing:
+				self.condition.wait(timeout)
+			return not (self.pending or self.writing)
+
+	def stop(self):
+		"""Sends anything still queued and then ends the thread"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.join(WRITE_TIMEOUT * 2)
+
+	def run(self):
+		"""Waits for queued commands and writes each batch of them with a single write"""
+		while True:
+			with self.condition:
+				while self.running and (self.paused or not self.pending):
+					self.condition.wait()
+				if not self.pending:
+					break
+				commands = list(self.pending.values())
+				self.pending.clear()
+				self.writing = True
+			try:
+				writeCommands(commands)
+			finally:
+				with self.condition:
+					self.writing = False
+					self.condition.notifyAll()
+
+serialWriter = SerialWriter()
+
+def getUSBIdentity(port):
+	"""Look up the USB (vendor id, product id, serial number) of a serial device, or None if it isn't a USB device we can find"""
+	try:
+		from serial.tools import list_ports
+		realport = os.path.realpath(port)
+		for device, description, hwid in list_ports.comports():
+			if os.path.realpath(device) == realport:
+				match = usbPattern.search(hwid)
+				if match:
+					return (match.group(1).lower(), match.group(2).lower(), match.group(3))
+	except Exception as e:
+		addLogEntry("Unable to look up USB device for %s: %s", xbmc.LOGDEBUG, port, e)
+	return None
+
+def findPort(port, identity):
+	"""Work out which device to open: the configured port if it's there, or else the USB device with the same identity
+	(which may have come back with a different name, e.g. /dev/ttyUSB1 instead of /dev/ttyUSB0). Returns None if neither is there.
+	"""
+	if (os.name != "posix") or ("://" in port) or os.path.exists(port):
+		return port
+	if identity is not None:
 		try:
-			serialPort.write(command + "\n")
+			from serial.tools import list_ports
+			for device, description, hwid in list_ports.comports():
+				match = usbPattern.search(hwid)
+				if match and ((match.group(1).lower(), match.group(2).lower()) == identity[:2]) and ((identity[2] is None) or (match.group(3) == identity[2])):
+					addLogEntry("Found %s again as %s", xbmc.LOGNOTICE, port, device)
+					return device
 		except Exception as e:
-			addLogEntry('Error writing to serial port: ' + str(e), xbmc.LOGERROR)
-	else:
-		addLogEntry("Tried to write to closed serial port", xbmc.LOGWARNING)
+			addLogEntry("Unable to search for USB device: %s", xbmc.LOGDEBUG, e)
+	return None
 
-def fadeLights(channel, startlevel, endlevel):
-	"""Fades the lights on a specified channel using the appropriate method and duration"""
-	startlevel = int(2.55 * int(startlevel))
-	endlevel = int(2.55 * int(endlevel))
-	duration = int(float(settings.getSetting("fadeduration"))* 1000)
-	if endlevel > startlevel:
-		method = "exponential "
-	else:
-		method = "logarithmic "
-	sendCommand(method + channel + "," + str(startlevel) + "," + str(endlevel) + "," + str(duration))
-
-def setLights(channel, level):
-	"""Sets the lights on a specified channel immediately to a given level"""
-	sendCommand("set " + channel + "," + str(int(2.55 * int(level))))
-
-def openPort():
-	"""Open the serial port and initialize the lights"""
-	serialport = settings.getSetting("serialport")
-	baudrate = settings.getSetting("baudrate")
-	addLogEntry("Opening serial port " + serialport + "@" + baudrate, xbmc.LOGDEBUG)
-	if serialPort.isOpen():
+class ConnectionSupervisor(threading.Thread):
+	"""Background thread that reopens the serial port when it fails (e.g. the USB adapter was unplugged),
+	waiting longer between each attempt, and brings the lights back to the current scene once it's open again.
+	"""
+	def __init__(self):
+		"""Initializes the supervisor; call start() to begin watching"""
+		threading.Thread.__init__(self, name="ConnectionSupervisor")
+		self.daemon = True
+		self.condition = threading.Condition()
+		self.running = True
+		self.lost = False
+		self.openrequested = False
+		self.openedport = None #device the serial port was last opened on
+		self.identity = None #USB identity of that device
+		self.received = "" #start of a line from the Arduino that hasn't been finished yet
+		self.wakeRead = self.wakeWrite = None
+		if hasattr(select, "poll"):
+			#a pipe to wake the supervisor up while it's waiting on the serial port
+			self.wakeRead, self.wakeWrite = os.pipe()
+
+	def connected(self, port):
+		"""Called when the serial port has been opened successfully"""
+		with self.condition:
+			self.lost = False
+			self.received = ""
+			if port != self.openedport:
+				self.openedport = port
+				self.identity = None
+			self.condition.notify()
+		self.wake()
+
+	def requestOpen(self):
+		"""Opens the serial port with the current settings on the supervisor's thread, so the caller doesn't wait for the Arduino"""
+		with self.condition:
+			self.openrequested = True
+			self.condition.notify()
+		self.wake()
+
+	def connectionLost(self):
+		"""Called when the serial port fails (or couldn't be opened) so it gets reopened"""
+		with self.condition:
+			if self.running and not self.lost:
+				addLogEntry("Lost connection to the serial port, will keep trying to reopen it", xbmc.LOGWARNING)
+				self.lost = True
+				#keep anything sent in the meantime (only the newest per channel) until the port is back
+				serialWriter.pause()
+				self.condition.notify()
+		self.wake()
+
+	def stop(self):
+		"""Stops watching the serial port"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.wake()
+		self.join(BANNER_TIMEOUT + WRITE_TIMEOUT) #let an attempt at reopening the port finish before it gets closed
+
+	def run(self):
+		"""Waits for the connection to fail, then keeps trying to reopen it"""
+		monitor = xbmc.Monitor() #its waitForAbort sleeps without polling and wakes up if Kodi is shutting down
+		while True:
+			with self.condition:
+				watched = None
+				while self.running and not (self.openrequested or self.lost or ((self.openedport is not None) and (self.identity is None))):
+					#while all's well, wait on the serial port itself if we can, to notice it going away even when nothing is being sent
+					watched = self.watchablePort()
+					if watched is not None:
+						break
+					self.condition.wait()
+				if not self.running:
+					return
+				openrequested = self.openrequested
+				self.openrequested = False
+				lost = self.lost
+				port = self.openedport
+			if watched is not None:
+				self.watchPort(*watched)
+				continue
+			if openrequested:
+				openPort()
+				continue
+			if not lost:
+				#remember what's plugged in while it's still there, so it can be found again if it comes back under another name
+				identity = getUSBIdentity(port)
+				with self.condition:
+					if port == self.openedport:
+						self.identity = identity or ()
+				continue
+			delay = RECONNECT_MIN_DELAY
+			while self.running and self.lost:
+				if monitor.waitForAbort(delay):
+					return
+				with self.condition:
+					self.openrequested = False #reconnecting uses the latest settings anyway
+				if self.running and self.lost:
+					self.reconnect()
+				delay = min(delay * 2, RECONNECT_MAX_DELAY)
+
+	def wake(self):
+		"""Interrupts watchPort, so the supervisor sees what has changed"""
+		if self.wakeWrite is not None:
+			try:
+				os.write(self.wakeWrite, "x")
+			except OSError:
+				pass
+
+	def watchablePort(self):
+		"""Gets the open serial port and its file descriptor if the supervisor can wait on it, otherwise None"""
+		port = serialPort
+		if (self.wakeRead is None) or (port is None) or not port.isOpen():
+			return None
+		try:
+			fd = port.fileno()
+		except (AttributeError, IOError, ValueError):
+			return None #e.g. the LightFader emulator, or a platform without file descriptors for serial ports
+		return port, fd
+
+	def watchPort(self, port, fd):
+		"""Waits until the serial port hangs up or something arrives from the Arduino, or the supervisor is woken up.
+		A hang up or error means the USB adapter was unplugged even if nothing has been sent since,
+		and a banner means the Arduino has reset (so its lights have gone out) and the current scene is sent again.
+		"""
+		global firmwareVersion
+		poller = select.poll()
+		poller.register(fd, select.POLLIN | select.POLLERR | select.POLLHUP)
+		poller.register(self.wakeRead, select.POLLIN)
+		try:
+			events = dict(poller.poll())
+		except (select.error, IOError, OSError) as e:
+			if e.args[0] != errno.EINTR:
+				addLogEntry("Unable to wait on the serial port: %s", xbmc.LOGWARNING, e)
+				monitor = xbmc.Monitor()
+				monitor.waitForAbort(RECONNECT_MIN_DELAY)
+			return
+		if self.wakeRead in events:
+			try:
+				os.read(self.wakeRead, 512)
+			except OSError:
+				pass
+		event = events.get(fd, 0)
+		if not event:
+			return
+		failure = None
+		data = ""
+		with portLock:
+			if (serialPort is not port) or not port.isOpen():
+				return #closed or replaced since (e.g. the settings changed), so its events don't mean anything
+			if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+				failure = "device hung up"
+			else:
+				try:
+					waiting = port.inWaiting()
+					if waiting:
+						data = port.read(waiting)
+					else:
+						failure = "device reports readiness to read but returned no data"
+				except Exception as e:
+					failure = e
+		if failure is not None:
+			addLogEntry("Serial port failed while idle: %s", xbmc.LOGDEBUG, failure)
+			self.connectionLost()
+			return
+		lines = (self.received + data).split("\n")
+		self.received = lines.pop()[-256:]
+		for line in lines:
+			addLogEntry("Received '%s'", xbmc.LOGDEBUG, line.strip())
+			version = parseBanner(line)
+			if version is not None:
+				firmwareVersion = version
+				addLogEntry("The Arduino has reset, sending the lights back to the current scene", xbmc.LOGWARNING)
+				initLights(None)
+
+	def reconnect(self):
+		"""Makes one attempt at reopening the serial port"""
+		cfg = config
+		if portIsOpen():
+			closePort(False)
+		port = findPort(cfg.serialport, self.identity or None)
+		if port is None:
+			addLogEntry("Waiting for %s to come back", xbmc.LOGDEBUG, cfg.serialport)
+			return False
+		if openPort(port, False):
+			statistics.countReconnect()
+			return True
+		return False
+
+supervisor = ConnectionSupervisor()
+
+def getStatus():
+	"""Gets everything worth knowing about how the add-on is doing, as a dict"""
+	return {
+		"version": __version__,
+		"time": time.time(),
+		"port": portSettings[0] if portSettings else None,
+		"connected": portIsOpen(),
+		"firmware": ".".join([str(part) for part in firmwareVersion]) if firmwareVersion else None,
+		"mode": modeNames[currentMode],
+		"blackout": blackedOut,
+		"fade_tables": tables.cache.stats(),
+		"startup_ms": OrderedDict([(stage, int(seconds * 1000)) for stage, seconds in startupTimes.items()]),
+		"statistics": statistics.snapshot()
+	}
+
+class StatusReporter(threading.Thread):
+	"""Background thread that keeps a JSON status file up to date in the add-on's profile folder,
+	and serves the same thing on a local web page if a port is set for it.
+	"""
+	def __init__(self):
+		"""Initializes the reporter; call start() to begin writing the status file"""
+		threading.Thread.__init__(self, name="StatusReporter")
+		self.daemon = True
+		self.running = True
+		self.path = os.path.join(xbmc.translatePath(settings.getAddonInfo("profile")), STATUS_FILE)
+		self.lastcontent = None #the status as last written, less the fields that change on every call
+		self.server = None
+		self.serverport = 0
+
+	def run(self):
+		"""Rewrites the status file every STATUS_INTERVAL seconds until Kodi shuts down"""
+		monitor = xbmc.Monitor()
+		while self.running:
+			refreshLogLevel() #Kodi doesn't say when debug logging is turned on or off, so check now and then
+			self.writeStatus()
+			if monitor.waitForAbort(STATUS_INTERVAL):
+				break
+
+	def stop(self):
+		"""Writes the status file one last time and stops the web page"""
+		self.running = False
+		self.writeStatus()
+		self.configure(0)
+
+	def writeStatus(self):
+		"""Writes the status file, if anything besides the clock has changed, by replacing it so readers never see half of one"""
+		status = getStatus()
+		#the time and uptime are always different, so leave them out when checking for changes (rewriting the file every STATUS_INTERVAL wears out SD cards)
+		clock = status.pop("time"), status["statistics"].pop("uptime")
+		content = json.dumps(status, sort_keys=True)
+		if content == self.lastcontent:
+			return
+		status["time"], status["statistics"]["uptime"] = clock
+		text = json.dumps(status, sort_keys=True, indent=1)
+		try:
+			folder = os.path.dirname(self.path)
+			if not os.path.isdir(folder):
+				os.makedirs(folder)
+			with open(self.path + ".tmp", "w") as statusfile:
+				statusfile.write(text)
+			if os.name == "nt" and os.path.exists(self.path):
+				os.remove(self.path) #rename won't replace a file on Windows
+			os.rename(self.path + ".tmp", self.path)
+			self.lastcontent = content
+		except (IOError, OSError) as e:
+			addLogEntry("Unable to write status file %s: %s", xbmc.LOGWARNING, self.path, e)
+
+	def configure(self, port):
+		"""Starts, moves or stops the status web page (port 0 turns it off)"""
+		if port == self.serverport:
+			return
+		if self.server is not None:
+			addLogEntry("Stopping status page on port %d", xbmc.LOGDEBUG, self.serverport)
+			self.server.shutdown()
+			self.server.server_close()
+			self.server = None
+		self.serverport = 0
+		if port:
+			try:
+				self.server = makeStatusServer(port)
+			except Exception as e:
+				addLogEntry("Unable to start status page on port %d: %s", xbmc.LOGERROR, port, e)
+				return
+			self.serverport = port
+			serverthread = threading.Thread(target=self.server.serve_forever, name="StatusServer")
+			serverthread.daemon = True
+			serverthread.start()
+			addLogEntry("Status page at http://127.0.0.1:%d/status", xbmc.LOGNOTICE, port)
+
+def makeStatusServer(port):
+	"""Creates a web server on localhost that answers with the status as JSON"""
+	try:
+		from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+	except ImportError:
+		from http.server import HTTPServer, BaseHTTPRequestHandler
+
+	class StatusHandler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			"""Answers requests for the status"""
+			if self.path.split("?")[0] not in ("/", "/status", "/status.json"):
+				self.send_error(404)
+				return
+			body = json.dumps(getStatus(), sort_keys=True, indent=1).encode("utf-8")
+			self.send_response(200)
+			self.send_header("Content-Type", "application/json")
+			self.send_header("Content-Length", str(len(body)))
+			self.send_header("Cache-Control", "no-cache")
+			self.end_headers()
+			self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			addLogEntry("Status page: " + format, xbmc.LOGDEBUG, *args)
+
+	return HTTPServer(("127.0.0.1", port), StatusHandler)
+
+statusReporter = StatusReporter()
+
+def sendCommands(commands, clearpending=False):
+	"""Queues (channel, command) pairs to be sent together; returns right away"""
+	if commands:
+		serialWriter.submit(commands, clearpending)
+
+def sendCommand(command, clearpending=False):
+	"""Queues a single command that isn't tied to a channel (a newline character is appended when it's sent)"""
+	sendCommands([(command, command)], clearpending)
+
+def fadeCommand(channel, startlevel, endlevel, duration):
+	"""Builds the command to fade the lights on a specified channel between two PWM levels using the appropriate method"""
+	return fadeCommandNames[fadeMode(startlevel, endlevel)] + " " + str(channel) + "," + str(startlevel) + "," + str(endlevel) + "," + str(duration)
+
+def setCommand(channel, level):
+	"""Builds the command to set the lights on a specified channel immediately to a given PWM level"""
+	return "set " + str(channel) + "," + str(level)
+
+def frameCommand(channel, level):
+	"""Builds the shortest command that sets a channel to a PWM level, for streamed frames"""
+	if firmwareAtLeast(1, 1, 2):
+		return "s " + str(channel) + "," + str(level) #abbreviations need a LightFader that announces its version
+	return setCommand(channel, level)
+
+def parseBanner(line):
+	"""Gets the firmware version (as a tuple of ints) from a line if it's the LightFader banner, otherwise None"""
+	match = bannerPattern.search(line)
+	if match:
+		return tuple([int(part) for part in match.group(1).split(".") if part])
+	return None
+
+def firmwareAtLeast(*version):
+	"""Check if the connected LightFader firmware is at least a given version, e.g. firmwareAtLeast(1, 2)"""
+	return (firmwareVersion is not None) and (firmwareVersion >= version)
+
+def waitForDevice(timeout=BANNER_TIMEOUT):
+	"""Find out when the Arduino is ready after the serial port is opened.
+	A list command is sent right away: an Arduino that didn't reset answers it with the level of each channel,
+	and one that did reset prints its banner once it has started up.
+	Returns the firmware version from the banner (or None) and the reported {channel: level} (or None).
+	"""
+	serialPort.write("list\n")
+	deadline = time.time() + timeout
+	levels = {}
+	oldtimeout = serialPort.getTimeout()
+	try:
+		while True:
+			remaining = deadline - time.time()
+			if remaining <= 0:
+				break
+			if levels:
+				#the rest of the list reply follows right behind the first line
+				remaining = min(remaining, LIST_TIMEOUT)
+			serialPort.setTimeout(remaining)
+			line = serialPort.readline()
+			if not line:
+				if levels:
+					break
+				continue
+			addLogEntry("Received '%s'", xbmc.LOGDEBUG, line.strip())
+			version = parseBanner(line)
+			if version is not None:
+				return version, None
+			match = channelPattern.search(line)
+			if match:
+				levels[int(match.group(1))] = int(match.group(2))
+	finally:
+		serialPort.setTimeout(oldtimeout)
+	return None, (levels or None)
+
+def openPort(port=None, notify=True):
+	"""Open the serial port (default the one in the settings) and initialize the lights.
+	If it can't be opened the connection supervisor keeps trying; notify shows the user an error the first time.
+	"""
+	global serialPort, firmwareVersion, portSettings
+	cfg = config
+	if port is None:
+		port = cfg.serialport
+	addLogEntry("Opening serial port %s@%d", xbmc.LOGDEBUG, port, cfg.baudrate)
+	if portIsOpen():
 		addLogEntry("Tried to open already opened serial port", xbmc.LOGWARNING)
 		closePort()
 
+	portSettings = (cfg.serialport, cfg.baudrate)
 	try:
-		serialPort.setPort(serialport)
-		serialPort.setBaudrate(int(baudrate) )
-		serialPort.setByteSize(serial.EIGHTBITS)
-		serialPort.setParity(serial.PARITY_NONE)
-		serialPort.setStopbits(serial.STOPBITS_ONE)
-		serialPort.open()
-		addLogEntry("Serial port successfully opened", xbmc.LOGDEBUG)
-		xbmc.sleep(2000) #We pause a moment here because the Arduino reboots when the serial port is opened
-		initLights()
+		newPort = makeSerialPort(port)
+		newPort.setBaudrate(cfg.baudrate)
+		newPort.setByteSize(serial.EIGHTBITS)
+		newPort.setParity(serial.PARITY_NONE)
+		newPort.setStopbits(serial.STOPBITS_ONE)
+		newPort.setWriteTimeout(WRITE_TIMEOUT)
+		#The Arduino reboots if DTR was dropped when the port was last closed, so hold off any writes until it says it's ready
+		serialWriter.pause()
+		with portLock:
+			serialPort = newPort
+			serialPort.open()
+			if (os.name == "posix") and ("://" not in port) and not hasattr(serialPort, "setHupcl"):
+				clearHupcl(serialPort)
+			addLogEntry("Serial port successfully opened", xbmc.LOGDEBUG)
+			openedtime = time.time()
+			version, levels = waitForDevice()
+		if version is not None:
+			firmwareVersion = version
+			addLogEntry("LightFader version %s ready after %.2f seconds", xbmc.LOGNOTICE, ".".join([str(part) for part in version]), time.time() - openedtime)
+		elif levels is not None:
+			addLogEntry("Arduino ready without resetting after %.2f seconds, lights held at their current levels", xbmc.LOGNOTICE, time.time() - openedtime)
+		else:
+			addLogEntry("No reply from the Arduino after %s seconds, assuming it's ready", xbmc.LOGWARNING, BANNER_TIMEOUT)
+		initLights(levels)
 	except Exception as e:
-		showNotification(__addonname__, settings.getLocalizedString(32000), icon=xbmcgui.NOTIFICATION_ERROR)
-		addLogEntry("Error opening serial port: " + str(e), xbmc.LOGERROR)
+		if notify:
+			showNotification(__addonname__, settings.getLocalizedString(32000), icon=xbmcgui.NOTIFICATION_ERROR)
+			addLogEntry("Error opening serial port: %s", xbmc.LOGERROR, e)
+		else:
+			addLogEntry("Error opening serial port: %s", xbmc.LOGDEBUG, e)
+		if portIsOpen():
+			with portLock:
+				serialPort.close()
+		supervisor.connectionLost()
 		return False
 	else:
+		markStartup("port open")
+		supervisor.connected(port)
+		serialWriter.resume()
 		return True
 
-def closePort():
-	"""Shut down the lights and close the serial port"""
-	if serialPort.isOpen():
+def closePort(lightsoff=True):
+	"""Shut down the lights (unless lightsoff is False) and close the serial port"""
+	if portIsOpen():
 		try:
-			addLogEntry("Turning lights off", xbmc.LOGDEBUG)
-			sendCommand("alloff")
+			if lightsoff:
+				addLogEntry("Turning lights off", xbmc.LOGDEBUG)
+				with stateLock:
+					sendCommand("alloff", True)
+					channelTracker.reset(0)
+				if not serialWriter.flush():
+					addLogEntry("Timed out waiting for the serial writer before closing the port", xbmc.LOGWARNING)
 			addLogEntry("Closing serial port", xbmc.LOGDEBUG)
-			serialPort.close()
+			with portLock:
+				serialPort.close()
 		except Exception as e:
-			addLogEntry("Error closing serial port: " + str(e), xbmc.LOGERROR)
+			addLogEntry("Error closing serial port: %s", xbmc.LOGERROR, e)
 	else:
 		addLogEntry("Tried to close already closed serial port", xbmc.LOGWARNING)
 
-def isDuringBlackout(whichLight=""):
-	"""Check to see if a given channel should be blacked out (based on user preferences and time).
-	If no channel is specified, returns if the time is during the blackout period.
+def getBlackoutSchedule(cfg, now=None):
+	"""Work out whether a time (default now) is during the blackout period, and how many seconds until that changes.
+	The number of seconds is None if there is no blackout period.
 	"""
-	startBlackoutTime = settings.getSetting("startblackouttime")
-	endBlackoutTime = settings.getSetting("endblackouttime")
-	if (xbmc.getCondVisibility("System.Time(" + startBlackoutTime + ", " + endBlackoutTime + ")") ):
-		#during blackout time
-		if (whichLight == ""):
-			return True
-		else:
-			if (settings.getSetting("blackout" + whichLight) == "true"):
-				#black out this light
+	if (cfg.startblackouttime is None) or (cfg.endblackouttime is None) or (cfg.startblackouttime == cfg.endblackouttime):
+		return False, None
+	if now is None:
+		now = time.time()
+	localnow = time.localtime(now)
+	seconds = localnow.tm_hour * 3600 + localnow.tm_min * 60 + localnow.tm_sec + (now % 1)
+	start = cfg.startblackouttime * 60
+	end = cfg.endblackouttime * 60
+	if start < end:
+		blackout = (seconds >= start) and (seconds < end)
+	else:
+		#the blackout period wraps around midnight
+		blackout = (seconds >= start) or (seconds < end)
+	if blackout:
+		boundary = end
+	else:
+		boundary = start
+	return blackout, (boundary - seconds) % 86400
+
+def isDuringBlackout():
+	"""Check to see if the current time is during the blackout period"""
+	return getBlackoutSchedule(config)[0]
+
+def fadeChannels(targets):
+	"""Fade (channel, level) pairs to their levels, each starting from wherever the light really is (which may be part way through another fade)"""
+	cfg = config
+	duration = cfg.fadeduration
+	curve = cfg.fadecurve if cfg.streamframes else None
+	table = scenes
+	now = time.time()
+	commands = []
+	streaming = False
+	for channel, endlevel in targets:
+		startlevel = channelTracker.fade(channel, endlevel, duration, now, curve, table.brightness.get(channel))
+		if startlevel is not None:
+			if startlevel == endlevel:
+				commands.append((channel, setCommand(channel, endlevel)))
+			elif curve is not None:
+				streaming = True #FrameStreamer sends the frames
+			else:
+				commands.append((channel, fadeCommand(channel, startlevel, endlevel, duration)))
+	sendCommands(commands)
+	if streaming:
+		frameStreamer.wake()
+
+class FrameStreamer(threading.Thread):
+	"""Background thread that steps fades from here instead of leaving them to the Arduino (the fadeoutput setting),
+	sending a set command for each channel whose level has changed, framerate times a second.
+	Each frame only sends as many bytes as the serial port can carry before the next one; channels that
+	don't fit are sent in the next frame, biggest changes first.
+	"""
+	def __init__(self):
+		"""Initializes the streamer; call start() to begin streaming when a fade is started"""
+		threading.Thread.__init__(self, name="FrameStreamer")
+		self.daemon = True
+		self.condition = threading.Condition()
+		self.running = True
+		self.active = False
+		self.sent = {} #channel -> (ChannelState, level) last sent for it
+
+	def wake(self):
+		"""Start sending frames, if it isn't already, because a streamed fade has been started"""
+		with self.condition:
+			self.active = True
+			self.condition.notify()
+
+	def stop(self):
+		"""Ends the thread"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.join(1)
+
+	def run(self):
+		"""Sends a frame every 1/framerate seconds while any streamed fade is running, and waits otherwise"""
+		nextframe = 0
+		while True:
+			with self.condition:
+				while self.running and not self.active:
+					self.condition.wait()
+				if not self.running:
+					return
+				self.active = False #wake() sets it again if a fade starts while this frame is being sent
+			cfg = config
+			period = 1.0 / cfg.framerate
+			now = time.time()
+			if nextframe < now - period:
+				nextframe = now #just woken up (or fell behind), so don't try to catch up
+			elif nextframe > now:
+				time.sleep(nextframe - now)
+			nextframe += period
+			if self.sendFrame(cfg, time.time()):
+				with self.condition:
+					self.active = True
+
+	def sendFrame(self, cfg, now):
+		"""Sends the levels that have changed since the last frame, returning True if there's more to send"""
+		budget = cfg.baudrate / 10.0 / cfg.framerate #bytes the port can carry in one frame (8 data bits, a start bit and a stop bit each)
+		more = False
+		changes = []
+		with stateLock:
+			for channel, state in channelTracker.streamed():
+				level = channelTracker.levelAt(channel, now)
+				if (now - state.starttime) * 1000 < state.duration:
+					more = True
+				last = self.sent.get(channel)
+				#a fade starts from where the light is, however it got there
+				lastlevel = last[1] if (last is not None) and (last[0] is state) else state.startlevel
+				if level != lastlevel:
+					changes.append((abs(level - lastlevel), channel, state, level))
+			changes.sort(reverse=True)
+			commands = []
+			size = 0
+			for change, channel, state, level in changes:
+				command = frameCommand(channel, level)
+				size += len(command) + 1
+				if commands and (size > budget):
+					more = True
+					break
+				commands.append((channel, command))
+				self.sent[channel] = (state, level)
+			sendCommands(commands)
+		if changes:
+			statistics.countFrame(len(commands), len(changes) - len(commands))
+		return more
+
+frameStreamer = FrameStreamer()
+
+def showScene(mode, blackout, coalesced=0):
+	"""Fade the lights from the scene being shown to the scene for the given mode and blackout state"""
+	global shownScene
+	with stateLock:
+		scene = sceneState(mode, blackout)
+		fadeChannels([(channel, endlevel) for channel, startlevel, endlevel in scenes.transitions[shownScene][scene]])
+		shownScene = scene
+	statistics.countSceneChange(coalesced)
+
+class SceneCoalescer(threading.Thread):
+	"""Background thread that holds back scene changes that come within the settle time of the last one, so a burst of
+	Kodi events (the end of one playlist item and the start of the next, pausing and resuming straight away) is shown
+	as the one net change, if any. A change on its own is shown straight away.
+	"""
+	def __init__(self):
+		"""Initializes the coalescer; call start() to begin showing changes"""
+		threading.Thread.__init__(self, name="SceneCoalescer")
+		self.daemon = True
+		self.condition = threading.Condition()
+		self.running = True
+		self.target = None #(mode, blackout) waiting to be shown, or None
+		self.deadline = 0 #when the target gets shown if nothing else comes along
+		self.coalesced = 0 #changes the target has replaced
+		self.delay = 0 #settle time of the last request
+		self.quietuntil = 0 #until when a change is held back because one was shown just before it
+
+	def request(self, mode, blackout, delay, hold=False):
+		"""Asks for a scene to be shown. Returns True if the caller should show it straight away, which it should unless
+		a change was shown or is waiting within the last delay seconds, or hold is set (for a change that's usually the
+		start of a burst). Otherwise the scene is shown once delay seconds pass without another request, replacing any
+		waiting to be shown, and False is returned.
+		"""
+		with self.condition:
+			now = time.time()
+			self.delay = delay
+			if (self.target is None) and (not hold) and (now >= self.quietuntil):
+				self.quietuntil = now + delay
 				return True
-	return False
+			if self.target is not None:
+				self.coalesced += 1
+			self.target = (mode, blackout)
+			self.deadline = now + delay
+			self.condition.notify()
+			return False
+
+	def settled(self):
+		"""Check whether nothing is waiting to be shown and the next change would be shown straight away"""
+		with self.condition:
+			return (self.target is None) and (time.time() >= self.quietuntil)
+
+	def cancel(self):
+		"""Forget any scene waiting to be shown (the lights are being set some other way)"""
+		with self.condition:
+			self.target = None
+			self.coalesced = 0
+
+	def stop(self):
+		"""Ends the thread without showing anything still waiting"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.join(1)
+
+	def run(self):
+		"""Waits for the settle time to pass after the last request and then shows the scene asked for"""
+		while True:
+			with self.condition:
+				while self.running and ((self.target is None) or (time.time() < self.deadline)):
+					self.condition.wait(None if self.target is None else (self.deadline - time.time()))
+				if not self.running:
+					return
+			#Take stateLock first like everything else does, then check nothing changed while waiting for it
+			with stateLock:
+				with self.condition:
+					if (self.target is None) or (time.time() < self.deadline):
+						continue
+					(mode, blackout), coalesced = self.target, self.coalesced
+					self.target = None
+					self.coalesced = 0
+					self.quietuntil = time.time() + self.delay
+				if coalesced:
+					addLogEntry("Settled on %s after %d more changes", xbmc.LOGDEBUG, modeNames[mode], coalesced)
+				showScene(mode, blackout, coalesced)
+
+sceneCoalescer = SceneCoalescer()
+
+def changeLightingState(mode, blackout, burst=False):
+	"""Change to the scene for the given mode and blackout state, fading from the scene being shown.
+	If a settle time is set, changes that follow within it of another are held until it passes without a newer one,
+	and burst (for events that are usually followed by others straight away) holds this one for at least BURST_SETTLE_TIME.
+	"""
+	global currentMode, blackedOut
+	with stateLock:
+		currentMode = mode
+		blackedOut = blackout
+		if config.settletime > 0:
+			delay = config.settletime / 1000.0
+			if burst:
+				delay = max(delay, BURST_SETTLE_TIME)
+			if not sceneCoalescer.request(mode, blackout, delay, burst):
+				return
+		showScene(mode, blackout)
+
+def syncLightingState(mode, blackout):
+	"""Fade every channel to the scene for the given mode and blackout state from whatever level it's at, without assuming a previous scene"""
+	global currentMode, blackedOut, shownScene
+	with stateLock:
+		sceneCoalescer.cancel()
+		table = scenes
+		fadeChannels(zip(table.channels, table.levels[sceneState(mode, blackout)]))
+		currentMode = mode
+		blackedOut = blackout
+		shownScene = sceneState(mode, blackout)
+
+def setLightingState(mode, blackout):
+	"""Set the lights immediately to the scene for the given mode and blackout state"""
+	global currentMode, blackedOut, shownScene
+	with stateLock:
+		sceneCoalescer.cancel()
+		table = scenes
+		sendCommands([(channel, setCommand(channel, level)) for channel, level in zip(table.channels, table.levels[sceneState(mode, blackout)]) if channelTracker.set(channel, level)])
+		currentMode = mode
+		blackedOut = blackout
+		shownScene = sceneState(mode, blackout)
 
-def handleBlackOut():
+def handleBlackOut(blackout):
 	"""Turn the lights off or on based on blackout time and user preferences"""
-	global blackedOut
-	houselevel = ""
-	aislelevel = ""
-	ambientlevel = ""
-	if currentMode == MODE_NORMAL:
-		houselevel = settings.getSetting("normalhousebrightness")
-		aislelevel = settings.getSetting("normalaislebrightness")
-		ambientlevel = settings.getSetting("normalambientbrightness")
-	elif currentMode == MODE_PLAYING:
-		houselevel = settings.getSetting("playhousebrightness")
-		aislelevel = settings.getSetting("playaislebrightness")
-		ambientlevel = settings.getSetting("playambientbrightness")
-	elif currentMode == MODE_PAUSED:
-		houselevel = settings.getSetting("pausehousebrightness")
-		aislelevel = settings.getSetting("pauseaislebrightness")
-		ambientlevel = settings.getSetting("pauseambientbrightness")
-	elif currentMode == MODE_SCREENSAVER:
-		houselevel = settings.getSetting("sshousebrightness")
-		aislelevel = settings.getSetting("ssaislebrightness")
-		ambientlevel = settings.getSetting("ssambientbrightness")
-
-	if isDuringBlackout():
+	if blackout:
 		addLogEntry("Blacking out lights")
-		if (settings.getSetting("blackouthouse") == "true") and (settings.getSetting("controlhouselighting") == "true"):
-			fadeLights(settings.getSetting("houselightingchannel"), houselevel, "0")
-		if (settings.getSetting("blackoutaisle") == "true") and (settings.getSetting("controlaislelighting") == "true"):
-			fadeLights(settings.getSetting("aislelightingchannel"), aislelevel, "0")
-		if (settings.getSetting("blackoutambient") == "true") and (settings.getSetting("controlambientlighting") == "true"):
-			fadeLights(settings.getSetting("ambientlightingchannel"), ambientlevel, "0")
-		blackedOut = True
+		changeLightingState(currentMode, True)
 	else:
 		addLogEntry("Blackout period over")
-		if (settings.getSetting("blackouthouse") == "true") and (settings.getSetting("controlhouselighting") == "true"):
-			fadeLights(settings.getSetting("houselightingchannel"), "0", houselevel)
-		if (settings.getSetting("blackoutaisle") == "true") and (settings.getSetting("controlaislelighting") == "true"):
-			fadeLights(settings.getSetting("aislelightingchannel"), "0", aislelevel)
-		if (settings.getSetting("blackoutambient") == "true") and (settings.getSetting("controlambientlighting") == "true"):
-			fadeLights(settings.getSetting("ambientlightingchannel"), "0", ambientlevel)
-		blackedOut = False
-
-def initLights():
-	"""Initialize lighting to the normal levels"""
-	global currentMode, blackedOut
-	#Base the current mode on what the player is doing
-	currentMode = getCurrentMode()
-	blackedOut = isDuringBlackout()
-	#house
-	if (settings.getSetting("controlhouselighting") == "true"):
-		#Fade from off to normal
-		channel = settings.getSetting("houselightingchannel")
-		startlevel = "0"
-		if isDuringBlackout("house"):
-			endlevel = "0"
-		else:
-			if currentMode == MODE_NORMAL:
-				endlevel = settings.getSetting("normalhousebrightness")
-			elif currentMode == MODE_PAUSED:
-				endlevel = settings.getSetting("pausehousebrightness")
-			elif currentMode == MODE_PLAYING:
-				endlevel = settings.getSetting("playhousebrightness")
-			elif currentMode == MODE_SCREENSAVER:
-				endlevel = settings.getSetting("sshousebrightness")
-			else:
-				endlevel = "0"
-		fadeLights(channel, startlevel, endlevel)
-	#aisle
-	if settings.getSetting("controlaislelighting") == "true":
-		#Fade from off to normal
-		channel = settings.getSetting("aislelightingchannel")
-		startlevel = "0"
-		if isDuringBlackout("aisle"):
-			endlevel = "0"
-		else:
-			if currentMode == MODE_NORMAL:
-				endlevel = settings.getSetting("normalaislebrightness")
-			elif currentMode == MODE_PAUSED:
-				endlevel = settings.getSetting("pauseaislebrightness")
-			elif currentMode == MODE_PLAYING:
-				endlevel = settings.getSetting("playaislebrightness")
-			elif currentMode == MODE_SCREENSAVER:
-				endlevel = settings.getSetting("ssaislebrightness")
-			else:
-				endlevel = "0"
-		fadeLights(channel, startlevel, endlevel)
-	#ambient
-	if settings.getSetting("controlambientlighting") == "true":
-		#Fade from off to normal
-		channel = settings.getSetting("ambientlightingchannel")
-		startlevel = "0"
-		if isDuringBlackout("ambient"):
-			endlevel = "0"
-		else:
-			if currentMode == MODE_NORMAL:
-				endlevel = settings.getSetting("normalambientbrightness")
-			elif currentMode == MODE_PAUSED:
-				endlevel = settings.getSetting("pauseambientbrightness")
-			elif currentMode == MODE_PLAYING:
-				endlevel = settings.getSetting("playambientbrightness")
-			elif currentMode == MODE_SCREENSAVER:
-				endlevel = settings.getSetting("ssambientbrightness")
-			else:
-				endlevel = "0"
-		fadeLights(channel, startlevel, endlevel)
+		changeLightingState(currentMode, False)
+
+class BlackoutScheduler(threading.Thread):
+	"""Background thread that sleeps until the blackout period starts or ends and then changes the lights,
+	waking up early to work the schedule out again when the settings change.
+	"""
+	def __init__(self):
+		"""Initializes the scheduler; call start() to begin following the blackout period"""
+		threading.Thread.__init__(self, name="BlackoutScheduler")
+		self.daemon = True
+		self.condition = threading.Condition()
+		self.running = True
+		self.rescheduled = False
+
+	def reschedule(self):
+		"""Work the schedule out again right away (the blackout times may have changed)"""
+		with self.condition:
+			self.rescheduled = True
+			self.condition.notify()
+
+	def stop(self):
+		"""Ends the thread"""
+		with self.condition:
+			self.running = False
+			self.condition.notify()
+		self.join(1)
 
-def getCurrentMode():
-	if xbmc.getCondVisibility("System.ScreenSaverActive"):
+	def run(self):
+		"""Checks the blackout period, then sleeps until it starts or ends (or is rescheduled)"""
+		while True:
+			blackout, wait = getBlackoutSchedule(config)
+			if blackedOut != blackout:
+				handleBlackOut(blackout)
+			if (wait is None) or (wait > BLACKOUT_RECHECK):
+				wait = BLACKOUT_RECHECK
+			deadline = time.time() + wait
+			with self.condition:
+				while self.running and not self.rescheduled and (time.time() < deadline):
+					self.condition.wait(deadline - time.time())
+				if not self.running:
+					return
+				self.rescheduled = False
+
+blackoutScheduler = BlackoutScheduler()
+
+def initLights(levels=None):
+	"""Bring the lights to the levels for whatever the player is doing.
+	levels is the {channel: level} the Arduino reported, or None if it has just reset (and so all of the lights are off).
+	"""
+	with stateLock:
+		#anything queued before now was meant for the lights as they were before the port was opened
+		serialWriter.clear()
+		channelTracker.reset(0)
+		if levels is not None:
+			for channel, level in levels.items():
+				channelTracker.set(channel, level)
+		syncLightingState(getCurrentMode(config), isDuringBlackout())
+
+def getCurrentMode(cfg, includeScreensaver=True):
+	"""Work out which lighting mode matches what Kodi is currently doing (respecting the dim on pause/screensaver settings)"""
+	if includeScreensaver and cfg.dimonscreensaver and xbmc.getCondVisibility("System.ScreenSaverActive"):
 		return MODE_SCREENSAVER
-	elif xbmc.getCondVisibility("Player.Paused"):
+	elif cfg.dimonpause and xbmc.getCondVisibility("Player.Paused"):
 		return MODE_PAUSED
-	elif xbmc.getCondVisibility("Player.Seeking|Player.Caching|Player.Playing|Player.Forwarding|Player.Rewinding"):
+	elif xbmc.getCondVisibility("Player.Paused|Player.Seeking|Player.Caching|Player.Playing|Player.Forwarding|Player.Rewinding"):
 		return MODE_PLAYING
 	else:
 		return MODE_NORMAL
@@ -272,144 +1519,51 @@ class MonitorHandler(xbmc.Monitor): #subclass of xbmc.Monitor so we can hear scr
 		"""Turn off the lights and close the serial port"""
 		addLogEntry("Monitor Handler stopping", xbmc.LOGDEBUG)
 
+	@timedCallback
 	def onSettingsChanged(self):
 		"""Called when the addon settings have been changed (from xbmc.Monitor)"""
-		global currentMode
-		#Base the current mode on what the player is currently doing
-		currentMode = getCurrentMode()
-		blackedOut = isDuringBlackout()
+		global config, scenes
+		refreshLogLevel()
 		addLogEntry("Settings changed", xbmc.LOGDEBUG)
+		#Swap in a fresh settings snapshot; callbacks already running keep using the one they started with
+		cfg = loadConfig()
+		with stateLock:
+			config = cfg
+			scenes = buildSceneTable(cfg)
 		#See if the serial port has been changed
-		if (serialPort.getPort() != settings.getSetting("serialport") ) or (serialPort.getBaudrate() != int(settings.getSetting("baudrate") ) ):
+		statusReporter.configure(cfg.statusport)
+		if portSettings != (cfg.serialport, cfg.baudrate):
 			#Close the port and reopen it with the new settings
 			addLogEntry("Serial port settings changed, reopening port")
-			closePort()
-			xbmc.sleep(200) #wait a tick to make sure the port closed
-			if openPort():
-				initLights()
-
-		houselevel = ""
-		aislelevel = ""
-		ambientlevel = ""
-		if (currentMode == MODE_NORMAL):
-			#change brightness for normal
-			if not isDuringBlackout("house"):
-				houselevel = settings.getSetting("normalhousebrightness")
-			else:
-				houselevel = "0"
-			if not isDuringBlackout("aisle"):
-				aislelevel = settings.getSetting("normalaislebrightness")
-			else:
-				aislelevel = "0"
-			if not isDuringBlackout("ambient"):
-				ambientlevel = settings.getSetting("normalambientbrightness")
-			else:
-				ambientlevel = "0"
-		elif (currentMode == MODE_PAUSED):
-			#change brightness for paused
-			if not isDuringBlackout("house"):
-				houselevel = settings.getSetting("pausehousebrightness")
-			else:
-				houselevel = "0"
-			if not isDuringBlackout("aisle"):
-				aislelevel = settings.getSetting("pauseaislebrightness")
-			else:
-				aislelevle = "0"
-			if not isDuringBlackout("ambient"):
-				ambientlevel = settings.getSetting("pauseambientbrightness")
-			else:
-				ambientlevel = "0"
-		elif (currentMode == MODE_PLAYING):
-			#change brightness for playing
-			if not isDuringBlackout("house"):
-				houselevel = settings.getSetting("playhousebrightness")
-			else:
-				houselevel = "0"
-			if not isDuringBlackout("aisle"):
-				aislelevel = settings.getSetting("playaislebrightness")
-			else:
-				aislelevle = "0"
-			if not isDuringBlackout("ambient"):
-				ambientlevel = settings.getSetting("playambientbrightness")
-			else:
-				ambientlevel = "0"
-		elif (currentMode == MODE_SCREENSAVER):
-			#change brightness for screensaver... this shouldn't happen, since the screensaver should be off when settings are being changed
-			if not isDuringBlackout("house"):
-				houselevel = settings.getSetting("sshousebrightness")
-			else:
-				houselevel = "0"
-			if not isDuringBlackout("aisle"):
-				aislelevel = settings.getSetting("ssaislebrightness")
-			else:
-				aislelevle = "0"
-			if not isDuringBlackout("ambient"):
-				ambientlevel = settings.getSetting("ssambientbrightness")
-			else:
-				ambientlevel = "0"
-		if (settings.getSetting("controlhouselighting") == "true"):
-			setLights(settings.getSetting("houselightingchannel"), houselevel)
-		if (settings.getSetting("controlaislelighting") == "true"):
-			setLights(settings.getSetting("aislelightingchannel"), aislelevel)
-		if (settings.getSetting("controlambientlighting") == "true"):
-			setLights(settings.getSetting("ambientlightingchannel"), ambientlevel)
+			if portIsOpen():
+				closePort()
+				xbmc.sleep(200) #wait a tick to make sure the port closed
+			supervisor.requestOpen()
+		else:
+			#Base the current mode on what the player is currently doing and show the new levels right away
+			setLightingState(getCurrentMode(cfg), isDuringBlackout())
+		#the blackout times may have changed, so the next start or end could be sooner than the scheduler expects
+		blackoutScheduler.reschedule()
 
+	@timedCallback
 	def onScreensaverActivated(self):
 		"""Called when the screen saver kicks in (from xbmc.Monitor)"""
-		global currentMode
 		addLogEntry("onScreensaverActivated", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		#fade from normal to screensaver
-		if (settings.getSetting("dimonscreensaver") == "true"):
-			#aisle
-			if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-				channel = settings.getSetting("aislelightingchannel")
-				startlevel = settings.getSetting("normalaislebrightness")
-				endlevel = settings.getSetting("ssaislebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#house
-			if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-				channel = settings.getSetting("houselightingchannel")
-				startlevel = settings.getSetting("normalhousebrightness")
-				endlevel = settings.getSetting("sshousebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#ambient
-			if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-				channel = settings.getSetting("ambientlightingchannel")
-				startlevel = settings.getSetting("normalambientbrightness")
-				endlevel = settings.getSetting("ssambientbrightness")
-				fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_SCREENSAVER
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		if config.dimonscreensaver:
+			changeLightingState(MODE_SCREENSAVER, blackedOut)
 
 	def onDPMSActivated(self):
 		self.onScreensaverActivated()
 
+	@timedCallback
 	def onScreensaverDeactivated(self):
 		"""Called when the screensaver goes off (from xbmc.Monitor)"""
-		global currentMode
 		addLogEntry("onScreensaverDectivated", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		#fade from screensaver to normal
-		if (settings.getSetting("dimonscreensaver") == "true"):
-			#house
-			if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-				channel = settings.getSetting("houselightingchannel")
-				startlevel = settings.getSetting("sshousebrightness")
-				endlevel = settings.getSetting("normalhousebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#aisle
-			if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-				channel = settings.getSetting("aislelightingchannel")
-				startlevel = settings.getSetting("ssaislebrightness")
-				endlevel = settings.getSetting("normalaislebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#ambient
-			if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-				channel = settings.getSetting("ambientlightingchannel")
-				startlevel = settings.getSetting("ssambientbrightness")
-				endlevel = settings.getSetting("normalambientbrightness")
-				fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_NORMAL
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		if currentMode == MODE_SCREENSAVER:
+			#go back to whatever the player was doing before the screensaver came on
+			changeLightingState(getCurrentMode(config, False), blackedOut)
 
 	def onDPMSDeactivated(self):
 		self.onScreensaverDeactivated()
@@ -428,133 +1582,44 @@ class AutomationHandler(xbmc.Player): #Subclass of xbmc.Player so we can hear th
 		"""Shut down"""
 		addLogEntry("Automation Handler stopping", xbmc.LOGDEBUG)
 
+	@timedCallback
 	def onPlayBackStarted(self):
 		"""Called by Kodi when playback starts; set the lights level for video playback (from xbmc.Player)"""
-		global currentMode
 		addLogEntry("onPlayBackStarted", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		
-		if currentMode==MODE_PAUSED:
-			#fade from pause to play
-			self.onPlayBackResumed()
-		elif currentMode==MODE_NORMAL:
-			#fade from normal to play
-			#aisle
-			if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-				channel = settings.getSetting("aislelightingchannel")
-				startlevel = settings.getSetting("normalaislebrightness")
-				endlevel = settings.getSetting("playaislebrightness")
-				fadeLights(channel, startlevel, endlevel)			
-			#house
-			if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-				channel = settings.getSetting("houselightingchannel")
-				startlevel = settings.getSetting("normalhousebrightness")
-				endlevel = settings.getSetting("playhousebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#ambient
-			if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-				channel = settings.getSetting("ambientlightingchannel")
-				startlevel = settings.getSetting("normalambientbrightness")
-				endlevel = settings.getSetting("playambientbrightness")
-				fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_PLAYING
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		changeLightingState(MODE_PLAYING, blackedOut)
 
+	@timedCallback
 	def onPlayBackEnded(self):
 		"""Called by Kodi when playback ends; Set the lights level to normal (from xbmc.Player)"""
-		global currentMode
 		addLogEntry("onPlayBackEnded", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		#fade from play to normal
-		#house
-		if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-			channel = settings.getSetting("houselightingchannel")
-			duration = settings.getSetting("fadeduration")
-			endlevel = settings.getSetting("normalhousebrightness")
-			if (currentMode == MODE_PAUSED):
-				startlevel = settings.getSetting("pausehousebrightness")
-			else:
-				startlevel = settings.getSetting("playhousebrightness")
-			fadeLights(channel, startlevel, endlevel)
-		#aisle
-		if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-			channel = settings.getSetting("aislelightingchannel")
-			endlevel = settings.getSetting("normalaislebrightness")
-			duration = settings.getSetting("fadeduration")
-			if (currentMode == MODE_PAUSED):
-				startlevel = settings.getSetting("pauseaislebrightness")
-			else:
-				startlevel = settings.getSetting("playaislebrightness")
-			fadeLights(channel, startlevel, endlevel)
-		#ambient
-		if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-			channel = settings.getSetting("ambientlightingchannel")
-			endlevel = settings.getSetting("normalambientbrightness")
-			duration = settings.getSetting("fadeduration")
-			if (currentMode == MODE_PAUSED):
-				startlevel = settings.getSetting("pauseambientbrightness")
-			else:
-				startlevel = settings.getSetting("playambientbrightness")
-			fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_NORMAL
+		self.playbackFinished(True) #if there's another playlist item, Kodi starts it straight away
 
+	@timedCallback
 	def onPlayBackStopped(self):
 		"""Called by Kodi when the user stops playback; set the lights level to normal (from xbmc.Player)"""
 		addLogEntry("onPlayBackStopped", xbmc.LOGDEBUG)
-		self.onPlayBackEnded()
+		self.playbackFinished()
+
+	def playbackFinished(self, burst=False):
+		"""Set the lights level to normal after playback ends or is stopped (not timed itself, so each callback is only counted once)"""
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		changeLightingState(MODE_NORMAL, blackedOut, burst)
 
+	@timedCallback
 	def onPlayBackPaused(self):
 		"""Called by Kodi when playback is paused; set the lights level to dim (from xbmc.Player)"""
-		global currentMode
 		addLogEntry("onPlayBackPaused", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		if (settings.getSetting("dimonpause") == "true"):
-			#fade from play to paused
-			#aisle
-			if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-				channel = settings.getSetting("aislelightingchannel")
-				startlevel = settings.getSetting("playaislebrightness")
-				endlevel = settings.getSetting("pauseaislebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#house
-			if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-				channel = settings.getSetting("houselightingchannel")
-				startlevel = settings.getSetting("playhousebrightness")
-				endlevel = settings.getSetting("pausehousebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#ambient
-			if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-				channel = settings.getSetting("ambientlightingchannel")
-				startlevel = settings.getSetting("playambientbrightness")
-				endlevel = settings.getSetting("pauseambientbrightness")
-				fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_PAUSED
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		if config.dimonpause:
+			changeLightingState(MODE_PAUSED, blackedOut)
 
+	@timedCallback
 	def onPlayBackResumed(self):
 		"""Called by Kodi when playback is resumed from paused; set the lights level for video playback (from xbmc.Player)"""
-		global currentMode
 		addLogEntry("onPlayBackResumed", xbmc.LOGDEBUG)
-		addLogEntry("Current Mode: " + modeNames[currentMode], xbmc.LOGDEBUG)
-		if (settings.getSetting("dimonpause") == "true"):
-			#fade from pause to play
-			#house
-			if (settings.getSetting("controlhouselighting") == "true") and (not isDuringBlackout("house") ):
-				channel = settings.getSetting("houselightingchannel")
-				startlevel = settings.getSetting("pausehousebrightness")
-				endlevel = settings.getSetting("playhousebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#aisle
-			if (settings.getSetting("controlaislelighting") == "true") and (not isDuringBlackout("aisle") ):
-				channel = settings.getSetting("aislelightingchannel")
-				startlevel = settings.getSetting("pauseaislebrightness")
-				endlevel = settings.getSetting("playaislebrightness")
-				fadeLights(channel, startlevel, endlevel)
-			#ambient
-			if (settings.getSetting("controlambientlighting") == "true") and (not isDuringBlackout("ambient") ):
-				channel = settings.getSetting("ambientlightingchannel")
-				startlevel = settings.getSetting("pauseambientbrightness")
-				endlevel = settings.getSetting("playambientbrightness")
-				fadeLights(channel, startlevel, endlevel)
-		currentMode = MODE_PLAYING
+		addLogEntry("Current Mode: %s", xbmc.LOGDEBUG, modeNames[currentMode])
+		changeLightingState(MODE_PLAYING, blackedOut)
 
 # -- Main Code ----------------------------------------------
 addLogEntry("Started")
@@ -564,14 +1629,23 @@ monitorhandler = MonitorHandler()
 
 if monitorhandler.start(): #Start the monitor handler and only continue if it succeeds
 	if playerhandler.start(): #Only run if startup succeeds
-		openPort()
-		while( True ): #Wait around for an abort signal from Kodi
-			if monitorhandler.waitForAbort(1):
-				break
-			if blackedOut != isDuringBlackout():
-				handleBlackOut()
+		serialWriter.start()
+		sceneCoalescer.start()
+		frameStreamer.start()
+		supervisor.start()
+		statusReporter.configure(config.statusport)
+		statusReporter.start()
+		supervisor.requestOpen() #the Arduino can take a couple of seconds to answer, so don't hold up Kodi starting
+		blackoutScheduler.start()
+		monitorhandler.waitForAbort() #Wait around for an abort signal from Kodi; callbacks run in the meantime
 		playerhandler.stop()
 	monitorhandler.stop()
-	closePort()
+	blackoutScheduler.stop()
+	supervisor.stop()
+	sceneCoalescer.stop()
+	frameStreamer.stop()
+	closePort(config.lightsoffonexit)
+	serialWriter.stop()
+	statusReporter.stop()
 
 addLogEntry("Stopped")
@@ -0,0 +1,17 @@
+#
+# LightFader emulator
+#
+# A model of the LightFader Arduino sketch (firmware) and a pySerial URL
+# handler (protocol_lightfader) for talking to it, so everything on the host
+# side can be exercised without an Arduino attached. The sketch's fade math is
+# in curves, and tables turns it into cached per-millisecond level tables
+# (with NumPy if it's installed), which the add-on uses to know where a light
+# is mid-fade:
+#
+#   import serial
+#   serial.protocol_handler_packages.append('lightfader')
+#   port = serial.serial_for_url('lightfader://')
+#
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+# This program is distributed under the GNU General Public License, version 3
+# or (at your option) any later version.
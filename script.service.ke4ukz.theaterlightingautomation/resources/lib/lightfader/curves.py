@@ -0,0 +1,112 @@
+#
+# LightFader fade curves - the math LightFader.ino uses for its fades
+#
+# linearFade, exponentialFade and logarithmicFade work out two coefficients
+# (a and b) for a channel, and fadeStep evaluates the curve once a
+# millisecond from then on. Both are reproduced here in single precision
+# floats with the sketch's quirks, so anything on the host side can tell
+# exactly what level a channel is at part way through a fade:
+#
+#   a, b = fadeCoefficients(FADE_EXPONENTIAL, 0, 255, 2000)
+#   level = fadeLevel(FADE_EXPONENTIAL, 0, 255, 2000, 500)
+#
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+# This program is distributed under the GNU General Public License, version 3
+# or (at your option) any later version.
+
+import math
+import struct
+
+FADE_NONE = 0
+FADE_LINEAR = 1
+FADE_EXPONENTIAL = 2
+FADE_LOGARITHMIC = 3
+
+
+def float32(value):
+    """Round a Python float to the nearest AVR float (IEEE single precision)"""
+    try:
+        return struct.unpack('f', struct.pack('f', value))[0]
+    except OverflowError:
+        return math.copysign(float('inf'), value)
+
+
+def power(base, exponent):
+    """avr-libc pow(): NaN instead of an exception for a negative base"""
+    try:
+        return math.pow(base, exponent)
+    except (ValueError, OverflowError):
+        return float('nan')
+
+
+def int16(value):
+    """Wrap an integer to a 16 bit signed int, as assigning a long to an int does"""
+    return ((value + 0x8000) & 0xFFFF) - 0x8000
+
+
+def floatToInt(value):
+    """Convert a float to a 16 bit int the way avr-gcc does: truncate toward zero.
+    Infinities and NaN (e.g. from log(0)) come out as 0 once truncated to 16 bits.
+    """
+    if math.isinf(value) or math.isnan(value):
+        return 0
+    return int16(int(value))
+
+
+def constrain(value, low, high):
+    """Arduino constrain()"""
+    return max(low, min(high, value))
+
+
+def fadeCoefficients(mode, start, end, duration):
+    """Work out (a, b) for a fade the way the sketch's *Fade functions do,
+    or None if the sketch would ignore the command (no duration)
+    """
+    if duration <= 0:
+        return None
+    if mode == FADE_LINEAR:
+        # y = a + b * x
+        return start, float32((end - start) / float32(duration))
+    elif mode == FADE_EXPONENTIAL:
+        # y = a * b ^ x, which won't work with zeroes, so the sketch makes them ones
+        if start == 0:
+            start = 1
+        if end == 0:
+            end = 1
+        return start, float32(power(float32(end / float32(start)), float32(1.0 / duration)))
+    elif mode == FADE_LOGARITHMIC:
+        # y = a + b * ln(x)
+        return start, float32((end - start) / float32(math.log(duration)))
+    return None
+
+
+def fadeValue(mode, a, b, x):
+    """Evaluate a fade curve at x milliseconds the way fadeStep does, before it becomes a PWM value"""
+    if mode == FADE_LINEAR:
+        return float32(a + float32(b * x))
+    elif mode == FADE_EXPONENTIAL:
+        return float32(a * float32(power(b, x)))
+    elif mode == FADE_LOGARITHMIC:
+        # log(0) is -infinity on the first step if the sketch gets to it in the same millisecond
+        return float32(a + float32(b * (float32(math.log(x)) if x > 0 else float('-inf'))))
+    return None
+
+
+def stepLevel(y):
+    """Turn a curve value into the PWM value fadeStep writes"""
+    return constrain(floatToInt(y), 0, 255)
+
+
+def fadeLevel(mode, start, end, duration, elapsed):
+    """The PWM value a channel fading from start to end over duration milliseconds
+    is at elapsed milliseconds after the fade started. Before the fade starts that's
+    start, and for a fade with no duration (which the sketch ignores) it's end.
+    """
+    if elapsed < 0:
+        return start
+    coefficients = fadeCoefficients(mode, start, end, duration)
+    if coefficients is None:
+        return end
+    # millis() only counts whole milliseconds, and fadeStep stops at the duration
+    x = min(int(elapsed), duration)
+    return stepLevel(fadeValue(mode, coefficients[0], coefficients[1], x))
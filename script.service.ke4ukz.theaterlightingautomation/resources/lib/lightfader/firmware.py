@@ -0,0 +1,441 @@
+#
+# LightFader emulator - model of the LightFader Arduino sketch
+#
+# This module reproduces what LightFader.ino does with the commands it is sent:
+# the same parsing (including abbreviations and splitInts quirks), the same
+# fadeStep math in single precision floats (see curves), and the same text
+# written back.
+#
+# Time is simulated in milliseconds and only moves forward when run() is
+# called, so the model can be driven from a wall clock (see
+# protocol_lightfader) or stepped through as fast as possible.
+#
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+# This program is distributed under the GNU General Public License, version 3
+# or (at your option) any later version.
+
+import math
+import time
+from collections import deque
+
+from lightfader.curves import (FADE_NONE, FADE_LINEAR, FADE_EXPONENTIAL, FADE_LOGARITHMIC,
+                               int16, constrain, fadeCoefficients, fadeValue, stepLevel)
+
+NAME = "LightFader"
+VERSION = "1.1.2"
+
+HELPMESSAGE = ("Commands:\nhelp\nexponential channel,from,to,time\nlogarithmic channel,from,to,time\n"
+               "linear channel,from,to,time\nset channel,value\nget channel\nlist\nalloff\n"
+               "Unambiguous abbreviations are also accepted")
+
+CHANNELS = (3, 5, 6)        # Arduino pin number for each channel
+BAUDRATE = 57600            # what setup() passes to Serial.begin()
+RX_BUFFER_SIZE = 64         # HardwareSerial ring buffer; one slot is always kept free
+TX_BUFFER_SIZE = 64
+READ_TIMEOUT = 1000         # Stream default for readStringUntil, in milliseconds
+BOOT_TIME = 1600            # bootloader wait after a reset before setup() runs, in milliseconds
+TTY_BUFFER_SIZE = 4096      # bytes the host's serial driver keeps for a reader before dropping them
+COMMAND_TIME = 0.2          # time spent parsing and acting on one command, in milliseconds
+
+
+def toInt(text):
+    """Arduino String.toInt(): atol() of the text, stored in a 16 bit int"""
+    text = text.lstrip(' \t\n\r\f\v')
+    digits = 0
+    if text[:1] in ('-', '+'):
+        digits = 1
+    while digits < len(text) and text[digits].isdigit():
+        digits += 1
+    try:
+        value = int(text[:digits])
+    except ValueError:
+        return 0
+    return int16(value)
+
+
+def splitInts(tosplit, delim, maxitems):
+    """Split tosplit into at most maxitems ints exactly like the sketch does.
+    Returns (number of items found, list of values).
+    """
+    values = []
+    for i in range(maxitems):
+        delimAt = tosplit.find(delim)
+        if delimAt > 0:
+            values.append(toInt(tosplit[:delimAt]))
+            tosplit = tosplit[delimAt + 1:]
+        elif delimAt == 0:
+            values.append(0)
+            tosplit = tosplit[1:]
+        else:
+            values.append(toInt(tosplit))
+            return i + 1, values
+    return maxitems, values
+
+
+def buildDate(when=None):
+    """Format a date the way the C preprocessor's __DATE__ does, e.g. 'Oct  7 2015'"""
+    when = time.localtime(when)
+    return "%s %2d %d" % (time.strftime("%b", when), when.tm_mday, when.tm_year)
+
+
+class LightFader(object):
+    """\
+    Model of an Arduino running LightFader.ino.
+
+    Bytes sent to it are handed to receive() along with the (simulated) time
+    their stop bit arrives. run() then advances the sketch up to a given time:
+    the receive interrupt fills the RX ring buffer (dropping bytes when it is
+    full), loop() steps the fades once per millisecond, and serialEvent() reads
+    and processes lines, which holds up the fades while it waits for the rest
+    of a line. Text the sketch prints is paced out at the baud rate and can be
+    collected with transmitted().
+
+    Counters useful for load testing are kept in stats().
+    """
+
+    def __init__(self, channels=CHANNELS, baudrate=BAUDRATE, rxbuffer=RX_BUFFER_SIZE,
+                 txbuffer=TX_BUFFER_SIZE, boottime=BOOT_TIME, commandtime=COMMAND_TIME,
+                 version=VERSION, date=None):
+        self.pins = tuple(channels)
+        self.bytetime = 10000.0 / baudrate      # milliseconds per byte with 8N1 framing
+        self.rxsize = rxbuffer
+        self.txsize = txbuffer
+        self.boottime = boottime
+        self.commandtime = commandtime
+        self.banner = "%s version %s (%s)" % (NAME, version, date or buildDate())
+        self.arrivals = deque()                 # (time, byte) not yet seen by the receive interrupt
+        self.transmitting = deque(maxlen=TTY_BUFFER_SIZE)  # (time the stop bit is sent, byte) printed by the sketch
+        self.listeners = []                     # called with (time, channel, value) for every analogWrite
+        self.rxline = 0                         # when the sender's UART will have finished sending what it was given
+        self.dtr = False                        # the board resets whenever the DTR line is raised
+        self.resetCounters()
+        self.reset(0)
+
+    def resetCounters(self):
+        """Zero the load testing counters"""
+        self.received = 0           # bytes that made it into the RX buffer
+        self.dropped = 0            # bytes lost because the RX buffer was full
+        self.commands = 0           # lines processed
+        self.errors = 0             # lines answered with "Invalid arguments", "Unknown command" or "Invalid channel"
+        self.timeouts = 0           # lines cut short by the readStringUntil timeout
+        self.latencies = []         # milliseconds from the end of each line arriving to it being acted on
+        self.maxstall = 0           # longest time the fades weren't stepped, in milliseconds
+
+    def stats(self):
+        """Return the load testing counters as a dict"""
+        latencies = sorted(self.latencies)
+        return {
+            'received': self.received,
+            'dropped': self.dropped,
+            'commands': self.commands,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'latency_max': latencies[-1] if latencies else 0,
+            'latency_median': latencies[len(latencies) // 2] if latencies else 0,
+            'max_stall': self.maxstall,
+        }
+
+    def reset(self, now):
+        """Reset the board (as raising DTR does) at time now, in milliseconds"""
+        self.clock = float(now)
+        self.epoch = self.clock + self.boottime  # millis() counts from when the sketch starts
+        self.running = False
+        self.values = [0] * len(self.pins)
+        self.fadeModes = [FADE_NONE] * len(self.pins)
+        self.startTimes = [0] * len(self.pins)
+        self.durations = [0] * len(self.pins)
+        self.aValues = [0] * len(self.pins)
+        self.bValues = [0.0] * len(self.pins)
+        self.rx = deque()
+        self.rxtimes = deque()
+        self.line = None            # characters read so far while serialEvent is blocked in readStringUntil
+        self.lastchar = 0
+        self.lastloop = None
+        self.txfree = self.clock    # when the UART will have sent everything queued
+        self.arrivals.clear()       # anything on its way is lost in the reset
+        self.transmitting.clear()
+        for channel in range(len(self.pins)):
+            self.analogWrite(channel, 0)
+
+    def millis(self):
+        """Value millis() would return at the current simulated time"""
+        return int(self.clock - self.epoch) & 0xFFFFFFFF
+
+    def receive(self, data, start, baudrate=None):
+        """Queue bytes sent to the board, starting at time start (ms) or once the line is
+        free, and return the time the last one finishes arriving. The bytes are paced at
+        the sketch's baud rate; if the sender used a different one they arrive as garbage.
+        """
+        arrival = max(start, self.rxline)
+        for byte in bytearray(data):
+            arrival += self.bytetime
+            if baudrate not in (None, BAUDRATE):
+                byte = 0xFF
+            self.arrivals.append((arrival, byte))
+        self.rxline = arrival
+        return arrival
+
+    def transmitted(self, now):
+        """Return the bytes the sketch has finished sending by time now (ms)"""
+        data = bytearray()
+        while self.transmitting and self.transmitting[0][0] <= now:
+            data.append(self.transmitting.popleft()[1])
+        return bytes(data)
+
+    def pending(self):
+        """Number of bytes still to be sent by the sketch"""
+        return len(self.transmitting)
+
+    def nextEvent(self):
+        """Time (ms) of the next thing that will happen in the model with no further input, or None"""
+        times = []
+        if self.arrivals:
+            times.append(self.arrivals[0][0])
+        if self.transmitting:
+            times.append(self.transmitting[0][0])
+        if not self.running:
+            times.append(self.epoch)
+        elif self.line is not None:
+            times.append(self.lastchar + READ_TIMEOUT)
+        elif self.rx:
+            times.append(self.clock)
+        elif any(self.fadeModes):
+            times.append(math.floor(self.clock) + 1)
+        return min(times) if times else None
+
+    # - - - simulation - - -
+
+    def interrupt(self):
+        """Receive interrupt: move every byte that has arrived by now into the RX buffer"""
+        while self.arrivals and self.arrivals[0][0] <= self.clock:
+            arrival, byte = self.arrivals.popleft()
+            if not self.running:
+                self.dropped += 1  # the bootloader doesn't pass anything on to the sketch
+            elif len(self.rx) < self.rxsize - 1:
+                self.rx.append(byte)
+                self.rxtimes.append(arrival)
+                self.received += 1
+            else:
+                self.dropped += 1
+
+    def elapse(self, duration):
+        """Spend duration milliseconds of the sketch's time (the interrupt keeps running)"""
+        self.clock += duration
+        self.interrupt()
+
+    def run(self, until):
+        """Run the sketch up to time until (ms)"""
+        while True:
+            self.interrupt()
+            if self.clock >= until:
+                break
+            if not self.running:
+                if self.clock < self.epoch:
+                    self.clock = min(self.epoch, until)
+                    continue
+                self.running = True
+                self.setup()
+                continue
+            if self.line is not None:
+                self.readLine(until)
+                continue
+            self.loop()
+            if self.rx:
+                self.serialEvent()
+                continue
+            # nothing to do until the next millisecond tick or byte, whichever comes first
+            nexttime = until
+            if self.arrivals:
+                nexttime = min(nexttime, self.arrivals[0][0])
+            if any(self.fadeModes):
+                nexttime = min(nexttime, math.floor(self.clock) + 1)
+            self.clock = max(self.clock, nexttime)
+            self.lastloop = self.clock  # loop() kept running the whole time
+
+    def readLine(self, until):
+        """Carry on with readStringUntil('\\n'), taking characters as they arrive until
+        a newline, the read timeout, or the end of the time being simulated
+        """
+        while self.rx:
+            byte = self.rx.popleft()
+            arrival = self.rxtimes.popleft()
+            self.lastchar = self.clock  # timedRead() starts its timeout again for each character
+            if byte == 0x0A:
+                line = self.line
+                self.line = None
+                self.processCommand(line, arrival)
+                if self.rx:
+                    self.line = ""
+                    self.lastchar = self.clock
+                return
+            self.line += chr(byte)
+        deadline = self.lastchar + READ_TIMEOUT
+        nexttime = min(deadline, until)
+        if self.arrivals:
+            nexttime = min(nexttime, self.arrivals[0][0])
+        self.clock = max(self.clock, nexttime)
+        self.interrupt()
+        if (self.clock >= deadline) and not self.rx:
+            line = self.line
+            self.line = None
+            self.timeouts += 1
+            self.processCommand(line, self.lastchar)
+
+    def serialEvent(self):
+        """Start reading a line (as serialEvent's readStringUntil does)"""
+        self.line = ""
+        self.lastchar = self.clock
+
+    def loop(self):
+        """One pass through loop(): step every channel's fade"""
+        if self.lastloop is not None:
+            self.maxstall = max(self.maxstall, self.clock - self.lastloop)
+        self.lastloop = self.clock
+        for channel in range(len(self.pins)):
+            self.fadeStep(channel)
+
+    def setup(self):
+        """setup(): print the banner"""
+        self.println(self.banner)
+
+    # - - - Arduino library - - -
+
+    def analogWrite(self, channel, value):
+        """Drive a channel's pin and tell anyone listening"""
+        for listener in self.listeners:
+            listener(self.clock, channel, value)
+
+    def write(self, text):
+        """Serial.print(): queue text in the TX buffer, waiting for room if it's full"""
+        for byte in bytearray(text.encode('latin-1') if not isinstance(text, bytes) else text):
+            # wait for room in the TX buffer (one slot is always kept free)
+            backlog = self.txfree - self.clock - (self.txsize - 1) * self.bytetime
+            if backlog > 0:
+                self.elapse(backlog)
+            self.txfree = max(self.txfree, self.clock) + self.bytetime
+            self.transmitting.append((self.txfree, byte))
+
+    def println(self, text=""):
+        """Serial.println()"""
+        self.write(str(text) + "\r\n")
+
+    # - - - LightFader.ino - - -
+
+    def setChannel(self, channel, value):
+        """Set the PWM value for a channel"""
+        if 0 <= channel < len(self.pins):
+            value = constrain(value, 0, 255)
+            self.fadeModes[channel] = FADE_NONE
+            self.analogWrite(channel, value)
+            self.values[channel] = value
+
+    def getChannel(self, channel):
+        """Print the value of a channel and return it, or -1 if the channel does not exist"""
+        if 0 <= channel < len(self.pins):
+            self.write("Channel ")
+            self.write(str(channel))
+            self.write(" (pin ")
+            self.write(str(self.pins[channel]))
+            self.write(") = ")
+            self.println(self.values[channel])
+            return self.values[channel]
+        else:
+            self.write("Invalid channel")  # no newline, as in the sketch
+            self.errors += 1
+            return -1
+
+    def startFade(self, channel, mode, a, b, duration):
+        """Record the parameters of a fade"""
+        self.aValues[channel] = a
+        self.bValues[channel] = b
+        self.startTimes[channel] = self.millis()
+        self.durations[channel] = duration
+        self.fadeModes[channel] = mode
+
+    def fade(self, channel, mode, start, end, duration):
+        """Start a fade of a channel along one of the curves (see curves.fadeCoefficients)"""
+        if 0 <= channel < len(self.pins) and duration > 0:
+            a, b = fadeCoefficients(mode, start, end, duration)
+            self.startFade(channel, mode, a, b, duration)
+
+    def linearFade(self, channel, start, end, duration):
+        """Fade a channel along y = a + b * x"""
+        self.fade(channel, FADE_LINEAR, start, end, duration)
+
+    def exponentialFade(self, channel, start, end, duration):
+        """Fade a channel along y = a * b ^ x"""
+        self.fade(channel, FADE_EXPONENTIAL, start, end, duration)
+
+    def logarithmicFade(self, channel, start, end, duration):
+        """Fade a channel along y = a + b * ln(x)"""
+        self.fade(channel, FADE_LOGARITHMIC, start, end, duration)
+
+    def processCommand(self, command, arrival=None):
+        """Act on one line received over the serial port"""
+        self.commands += 1
+        if arrival is not None:
+            self.latencies.append(self.clock - arrival)
+        self.elapse(self.commandtime)
+        if command.endswith("\r"):
+            command = command[:-1]
+        spaceAt = command.find(' ')
+        if spaceAt >= 0:
+            task = command[:spaceAt].lower()
+            params = command[spaceAt + 1:]
+            if task in ("set", "s"):
+                count, args = splitInts(params, ',', 2)
+                if count == 2:
+                    self.setChannel(args[0], args[1])
+                else:
+                    self.invalid("Invalid arguments")
+            elif task in ("get", "g"):
+                self.getChannel(toInt(params))
+            elif task in ("exponential", "e", "linear", "lin", "logarithmic", "lo"):
+                count, args = splitInts(params, ',', 4)
+                if count != 4:
+                    self.invalid("Invalid arguments")
+                elif task in ("exponential", "e"):
+                    self.exponentialFade(*args)
+                elif task in ("linear", "lin"):
+                    self.linearFade(*args)
+                else:
+                    self.logarithmicFade(*args)
+            else:
+                self.invalid("Unknown command")
+        else:
+            command = command.lower()
+            if command in ("help", "h"):
+                self.println(HELPMESSAGE)
+            elif command in ("list", "lis"):
+                for channel in range(len(self.pins)):
+                    self.getChannel(channel)
+            elif command in ("alloff", "a"):
+                for channel in range(len(self.pins)):
+                    self.analogWrite(channel, 0)
+                    self.values[channel] = 0
+                    self.fadeModes[channel] = FADE_NONE
+            else:
+                self.invalid("Unknown command")
+
+    def invalid(self, message):
+        """Print an error message and count it"""
+        self.errors += 1
+        self.println(message)
+
+    def fadeStep(self, channel):
+        """Calculate and apply the next value for a fading channel"""
+        mode = self.fadeModes[channel]
+        if mode == FADE_NONE:
+            return
+        x = (self.millis() - self.startTimes[channel]) & 0xFFFFFFFF
+        if x > self.durations[channel]:
+            x = self.durations[channel]
+        y = fadeValue(mode, self.aValues[channel], self.bValues[channel], x)
+        if y is None:
+            return
+        y = stepLevel(y)
+        if x == self.durations[channel]:
+            self.fadeModes[channel] = FADE_NONE
+        if y != self.values[channel]:
+            self.analogWrite(channel, y)
+            self.values[channel] = y
@@ -0,0 +1,360 @@
+#
+# LightFader emulator - pySerial URL handler
+#
+# This module implements a serial port with an emulated Arduino running
+# LightFader.ino on the other end (see firmware.py), paced in real time at the
+# sketch's baud rate. It lets the add-on and the serial code be run,
+# benchmarked and load tested without any hardware.
+#
+# Add the lightfader package to serial.protocol_handler_packages to make
+# serial.serial_for_url() find it.
+#
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+# This program is distributed under the GNU General Public License, version 3
+# or (at your option) any later version.
+#
+# URL format:    lightfader://[name][/option[/option...]]
+# Ports opened with the same name talk to the same emulated board, which keeps
+# its state (lights, fades) while the port is closed, just like the real thing.
+# options:
+# - "boot=<ms>" time the bootloader waits after a reset before the banner
+# - "rxbuffer=<bytes>" size of the receive ring buffer (default 64)
+# - "commandtime=<ms>" time the sketch takes to act on each command
+# - "logging=<level>" print diagnostic messages
+
+from serial.serialutil import *
+import threading
+import time
+import logging
+
+from lightfader import firmware
+
+# map log level names to constants. used in fromURL()
+LOGGER_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    }
+
+# emulated boards by name, shared by every port opened on them
+devices = {}
+devices_lock = threading.Lock()
+
+
+def getDevice(name, **options):
+    """Return the emulated board with the given name, creating it if needed.
+    options are passed on to firmware.LightFader when it is created."""
+    devices_lock.acquire()
+    try:
+        if name not in devices:
+            devices[name] = firmware.LightFader(**options)
+            devices[name].lock = threading.Lock()
+        return devices[name]
+    finally:
+        devices_lock.release()
+
+
+def now():
+    """Current time in the emulator's milliseconds"""
+    return time.time() * 1000.0
+
+
+class LightFaderSerial(SerialBase):
+    """Serial port connected to an emulated LightFader Arduino."""
+
+    BAUDRATES = (50, 75, 110, 134, 150, 200, 300, 600, 1200, 1800, 2400, 4800,
+                 9600, 19200, 38400, 57600, 115200)
+
+    _hupcl = None
+
+    def setHupcl(self, hupcl):
+        """Change the HUPCL (hang up on close) setting. When False, DTR stays
+        up after the port is closed so opening it again doesn't reset the
+        emulated board. None behaves like the usual system default (True)."""
+        self._hupcl = hupcl
+
+    def getHupcl(self):
+        """Get the current HUPCL setting."""
+        return self._hupcl
+
+    hupcl = property(getHupcl, setHupcl, doc="HUPCL (hang up on close) setting")
+
+    def open(self):
+        """Open port with current settings. This may throw a SerialException
+           if the port cannot be opened."""
+        if self._isOpen:
+            raise SerialException("Port is already open.")
+        self.logger = None
+        if self._port is None:
+            raise SerialException("Port must be configured before it can be used.")
+        self.device = self.fromURL(self.port)
+        self._reconfigurePort()
+        self.device.lock.acquire()
+        try:
+            if not self.device.dtr:
+                # opening the port raises DTR, which resets the board
+                if self.logger:
+                    self.logger.info('resetting emulated board')
+                self.device.dtr = True
+                self.device.reset(now())
+            else:
+                self.device.run(now())
+            self.device.transmitted(now())  # nothing from before the port was opened
+        finally:
+            self.device.lock.release()
+        self._isOpen = True
+
+    def _reconfigurePort(self):
+        """Set communication parameters on opened port. Only the baud rate
+        matters: if it doesn't match the sketch's, it receives garbage."""
+        if not isinstance(self._baudrate, (int, long)) or not 0 < self._baudrate < 2**32:
+            raise ValueError("invalid baudrate: %r" % (self._baudrate))
+        if self.logger:
+            self.logger.info('_reconfigurePort()')
+
+    def close(self):
+        """Close port"""
+        if self._isOpen:
+            self._isOpen = False
+            if self._hupcl is not False:
+                self.device.dtr = False
+
+    def makeDeviceName(self, port):
+        raise SerialException("there is no sensible way to turn numbers into URLs")
+
+    def fromURL(self, url):
+        """extract the board name and options from an URL string and return the board"""
+        if url.lower().startswith("lightfader://"): url = url[13:]
+        options = {}
+        try:
+            parts = url.split('/')
+            name = parts[0]
+            # process options now, directly altering self
+            for option in parts[1:]:
+                if '=' in option:
+                    option, value = option.split('=', 1)
+                else:
+                    value = None
+                if not option:
+                    pass
+                elif option == 'logging':
+                    logging.basicConfig()   # XXX is that good to call it here?
+                    self.logger = logging.getLogger('pySerial.lightfader')
+                    self.logger.setLevel(LOGGER_LEVELS[value])
+                    self.logger.debug('enabled logging')
+                elif option == 'boot':
+                    options['boottime'] = float(value)
+                elif option == 'rxbuffer':
+                    options['rxbuffer'] = int(value)
+                elif option == 'commandtime':
+                    options['commandtime'] = float(value)
+                else:
+                    raise ValueError('unknown option: %r' % (option,))
+        except (ValueError, KeyError, TypeError), e:
+            raise SerialException('expected a string in the form "lightfader://[name][/option[/option...]]": %s' % e)
+        device = getDevice(name, **options)
+        # options given again for a board that already exists apply from now on
+        if 'boottime' in options: device.boottime = options['boottime']
+        if 'commandtime' in options: device.commandtime = options['commandtime']
+        return device
+
+    #  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+
+    def inWaiting(self):
+        """Return the number of characters currently in the input buffer."""
+        if not self._isOpen: raise portNotOpenError
+        self.device.lock.acquire()
+        try:
+            self.device.run(now())
+            count = sum(1 for sent, byte in self.device.transmitting if sent <= self.device.clock)
+        finally:
+            self.device.lock.release()
+        if self.logger:
+            self.logger.debug('inWaiting() -> %d' % (count,))
+        return count
+
+    def read(self, size=1):
+        """Read size bytes from the serial port. If a timeout is set it may
+        return less characters as requested. With no timeout it will block
+        until the requested number of bytes is read."""
+        if not self._isOpen: raise portNotOpenError
+        if self._timeout is not None:
+            timeout = time.time() + self._timeout
+        else:
+            timeout = None
+        data = bytearray()
+        while size > 0:
+            self.device.lock.acquire()
+            try:
+                self.device.run(now())
+                block = self.device.transmitted(self.device.clock)
+                if len(block) > size:
+                    # put back what wasn't asked for
+                    sent = self.device.clock
+                    for byte in reversed(bytearray(block[size:])):
+                        self.device.transmitting.appendleft((sent, byte))
+                    block = block[:size]
+                upcoming = self.device.nextEvent()
+            finally:
+                self.device.lock.release()
+            data += block
+            size -= len(block)
+            if size <= 0:
+                break
+            # check for timeout now, after data has been read.
+            # useful for timeout = 0 (non blocking) read
+            if timeout is not None and time.time() >= timeout:
+                break
+            wait = 0.05
+            if upcoming is not None:
+                wait = min(wait, max(0.0005, (upcoming - now()) / 1000.0))
+            if timeout is not None:
+                wait = min(wait, max(0, timeout - time.time()))
+            time.sleep(wait)
+        return bytes(data)
+
+    def write(self, data):
+        """Output the given string over the serial port. Can block if the
+        driver's buffer is full, and raises writeTimeoutError if that lasts
+        longer than the write timeout."""
+        if not self._isOpen: raise portNotOpenError
+        # ensure we're working with bytes
+        data = to_bytes(data)
+        if self._writeTimeout is not None:
+            timeout = time.time() + self._writeTimeout
+        else:
+            timeout = None
+        self.device.lock.acquire()
+        try:
+            # the driver holds on to as much as TTY_BUFFER_SIZE bytes that haven't gone down the line yet
+            backlog = (self.device.rxline - now()) / self.device.bytetime + len(data) - firmware.TTY_BUFFER_SIZE
+            wait = max(0, backlog) * self.device.bytetime / 1000.0
+        finally:
+            self.device.lock.release()
+        if wait > 0:
+            if timeout is not None and time.time() + wait > timeout:
+                time.sleep(max(0, timeout - time.time()))
+                raise writeTimeoutError
+            time.sleep(wait)
+        self.device.lock.acquire()
+        try:
+            self.device.run(now())
+            self.device.receive(data, now(), self._baudrate)
+        finally:
+            self.device.lock.release()
+        if self.logger:
+            self.logger.debug('write(%r)' % (data,))
+        return len(data)
+
+    def flush(self):
+        """Wait until everything written has been sent down the line."""
+        if not self._isOpen: raise portNotOpenError
+        wait = (self.device.rxline - now()) / 1000.0
+        if wait > 0:
+            time.sleep(wait)
+
+    def flushInput(self):
+        """Clear input buffer, discarding all that is in the buffer."""
+        if not self._isOpen: raise portNotOpenError
+        if self.logger:
+            self.logger.info('flushInput()')
+        self.device.lock.acquire()
+        try:
+            self.device.run(now())
+            self.device.transmitted(self.device.clock)
+        finally:
+            self.device.lock.release()
+
+    def flushOutput(self):
+        """Clear output buffer, aborting the current output and
+        discarding all that is in the buffer."""
+        if not self._isOpen: raise portNotOpenError
+        if self.logger:
+            self.logger.info('flushOutput()')
+
+    def sendBreak(self, duration=0.25):
+        """Send break condition. Timed, returns to idle state after given
+        duration."""
+        if not self._isOpen: raise portNotOpenError
+
+    def setBreak(self, level=True):
+        """Set break: Controls TXD. When active, to transmitting is
+        possible."""
+        if not self._isOpen: raise portNotOpenError
+        if self.logger:
+            self.logger.info('setBreak(%r)' % (level,))
+
+    def setRTS(self, level=True):
+        """Set terminal status line: Request To Send"""
+        if not self._isOpen: raise portNotOpenError
+        if self.logger:
+            self.logger.info('setRTS(%r)' % (level,))
+
+    def setDTR(self, level=True):
+        """Set terminal status line: Data Terminal Ready. Raising it resets
+        the emulated board."""
+        if not self._isOpen: raise portNotOpenError
+        if self.logger:
+            self.logger.info('setDTR(%r)' % (level,))
+        self.device.lock.acquire()
+        try:
+            if level and not self.device.dtr:
+                self.device.reset(now())
+            self.device.dtr = level
+        finally:
+            self.device.lock.release()
+
+    def getCTS(self):
+        """Read terminal status line: Clear To Send"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    def getDSR(self):
+        """Read terminal status line: Data Set Ready"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    def getRI(self):
+        """Read terminal status line: Ring Indicator"""
+        if not self._isOpen: raise portNotOpenError
+        return False
+
+    def getCD(self):
+        """Read terminal status line: Carrier Detect"""
+        if not self._isOpen: raise portNotOpenError
+        return True
+
+    # - - - platform specific - - -
+    # None so far
+
+
+# assemble Serial class with the platform specific implementation and the base
+# for file-like behavior. for Python 2.6 and newer, that provide the new I/O
+# library, derive from io.RawIOBase
+try:
+    import io
+except ImportError:
+    # classic version with our own file-like emulation
+    class Serial(LightFaderSerial, FileLike):
+        pass
+else:
+    # io library present
+    class Serial(LightFaderSerial, io.RawIOBase):
+        pass
+
+
+# simple client test
+if __name__ == '__main__':
+    import sys
+    s = Serial('lightfader://test/boot=100')
+    s.timeout = 1
+    sys.stdout.write('%s\n' % s)
+    sys.stdout.write('banner: %r\n' % s.readline())
+
+    s.write("list\n")
+    for i in range(3):
+        sys.stdout.write('read: %r\n' % s.readline())
+    sys.stdout.write('%s\n' % s.device.stats())
+
+    s.close()
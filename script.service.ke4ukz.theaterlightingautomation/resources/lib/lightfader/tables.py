@@ -0,0 +1,145 @@
+#
+# LightFader fade tables - every level of a fade, a millisecond at a time
+#
+# fadeTable() gives the PWM value fadeStep writes at each millisecond of a
+# fade (index 0 to the duration), worked out with the math in curves,
+# including the sketch's truncation to a 16 bit int and constrain(0, 255).
+# With NumPy the table is a uint8 array computed in one go; without it it's
+# an array('B') computed a step at a time. NumPy is only imported when the
+# first table is needed, since it takes a while to load on small boards.
+# Either way looking up a level is a single index:
+#
+#   levels = fadeTable(FADE_EXPONENTIAL, 0, 255, 2000)
+#   levels[500]
+#
+# Tables are kept in a least recently used cache keyed by (mode, start, end,
+# duration), so asking for the same fade again costs nothing.
+#
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+# This program is distributed under the GNU General Public License, version 3
+# or (at your option) any later version.
+
+import array
+import threading
+from collections import OrderedDict
+
+from lightfader import curves
+
+CACHE_SIZE = 64             # tables kept; a 2 second fade's table is about 2 KB
+
+numpy = None                # the numpy module once loadNumpy() has found it
+numpyChecked = False        # whether loadNumpy() has tried yet
+
+
+def loadNumpy():
+    """Import NumPy the first time it's wanted. Returns the module, or None if it isn't installed."""
+    global numpy, numpyChecked
+    if not numpyChecked:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+        numpyChecked = True
+    return numpy
+
+
+def computeTable(mode, start, end, duration):
+    """Work out the level at every millisecond of a fade (see fadeTable), without the cache"""
+    duration = max(int(duration), 0)
+    numpy = loadNumpy()
+    coefficients = curves.fadeCoefficients(mode, start, end, duration)
+    if coefficients is None:
+        # the sketch ignores a fade with no duration; the table is just where it was asked to go
+        levels = [curves.constrain(end, 0, 255)] * (duration + 1)
+        return numpy.array(levels, dtype=numpy.uint8) if numpy is not None else array.array('B', levels)
+    a, b = coefficients
+    if numpy is None:
+        return array.array('B', [curves.stepLevel(curves.fadeValue(mode, a, b, x)) for x in range(duration + 1)])
+    return numpyTable(mode, a, b, duration)
+
+
+def numpyTable(mode, a, b, duration):
+    """fadeValue and stepLevel for every x at once. Each float32 operation is rounded the same
+    way as curves does it (working in doubles and rounding each result to single precision).
+    """
+    numpy = loadNumpy()
+    f32 = numpy.float32
+    x = numpy.arange(duration + 1, dtype=numpy.float64)
+    with numpy.errstate(all='ignore'):
+        if mode == curves.FADE_LINEAR:
+            y = f32(a) + (f32(b) * x.astype(f32))
+        elif mode == curves.FADE_EXPONENTIAL:
+            y = f32(a) * numpy.power(numpy.float64(b), x).astype(f32)
+        else:
+            # log(0) is -infinity on the first step, which ends up as 0 like it does on the board
+            y = f32(a) + (f32(b) * numpy.log(x).astype(f32))
+        y = y.astype(f32)
+        # floatToInt: truncate toward zero, infinities and NaN become 0, then wrap to 16 bits
+        y = numpy.where(numpy.isfinite(y), numpy.trunc(y), 0).astype(numpy.int64)
+        y = ((y + 0x8000) & 0xFFFF) - 0x8000
+    return numpy.clip(y, 0, 255).astype(numpy.uint8)
+
+
+class TableCache(object):
+    """\
+    Least recently used cache of fade tables, safe to share between threads.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self.tables = OrderedDict()     # (mode, start, end, duration) -> table, least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, mode, start, end, duration, compute=True):
+        """Get the table for a fade, computing it if it isn't cached (or returning None if compute is False)"""
+        key = (mode, start, end, duration)
+        with self.lock:
+            table = self.tables.pop(key, None)
+            if table is not None:
+                self.tables[key] = table
+                self.hits += 1
+                return table
+            self.misses += 1
+        if not compute:
+            return None
+        table = computeTable(mode, start, end, duration)
+        with self.lock:
+            self.tables[key] = table
+            while len(self.tables) > self.maxsize:
+                self.tables.popitem(False)
+        return table
+
+    def clear(self):
+        """Forget every table"""
+        with self.lock:
+            self.tables.clear()
+
+    def stats(self):
+        """Counts of tables held and lookups that found or missed one"""
+        with self.lock:
+            return {'tables': len(self.tables), 'hits': self.hits, 'misses': self.misses}
+
+
+cache = TableCache()
+
+
+def fadeTable(mode, start, end, duration):
+    """The PWM value at each millisecond (0 to duration) of a fade, from the cache"""
+    return cache.get(mode, start, end, duration)
+
+
+def fadeLevel(mode, start, end, duration, elapsed):
+    """curves.fadeLevel by table lookup. Without NumPy a table is only used if it's already
+    cached, since working one out a step at a time costs far more than the one level asked for.
+    """
+    if elapsed < 0:
+        return start
+    if duration <= 0:
+        return curves.fadeLevel(mode, start, end, duration, elapsed)
+    table = cache.get(mode, start, end, duration, compute=loadNumpy() is not None)
+    if table is None:
+        return curves.fadeLevel(mode, start, end, duration, elapsed)
+    return int(table[min(int(elapsed), duration)])
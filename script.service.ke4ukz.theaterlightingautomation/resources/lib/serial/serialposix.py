@@ -15,6 +15,13 @@
 import sys, os, fcntl, termios, struct, select, errno, time
 from serial.serialutil import *
 
+# FileIO and memoryview let readinto read straight into a caller's buffer,
+# which os.read can't do in Python 2. memoryview is new in Python 2.7.
+if (sys.hexversion >= 0x020700f0):
+    from io import FileIO
+else:
+    FileIO = None
+
 # Do check the Python version as some constants have moved.
 if (sys.hexversion < 0x020100f0):
     import TERMIOS
@@ -276,6 +283,24 @@ class PosixSerial(SerialBase):
     done with termios and fcntl. Runs on Linux and many other Un*x like
     systems."""
 
+    _hupcl = None       # None: leave the HUPCL flag as the system has it
+    _fileio = None      # FileIO on the open port's fd, for readinto
+
+    def setHupcl(self, hupcl):
+        """Change the HUPCL (hang up on close) setting. When False, DTR and
+        RTS stay asserted after the port is closed, so the next open does not
+        produce the DTR edge that resets devices like the Arduino. The kernel
+        raises DTR on every open, so the edge can only be avoided by never
+        dropping the line. None leaves the flag as it is."""
+        self._hupcl = hupcl
+        if self._isOpen: self._reconfigurePort()
+
+    def getHupcl(self):
+        """Get the current HUPCL setting."""
+        return self._hupcl
+
+    hupcl = property(getHupcl, setHupcl, doc="HUPCL (hang up on close) setting")
+
     def open(self):
         """Open port with current settings. This may throw a SerialException
            if the port cannot be opened."""
@@ -305,6 +330,8 @@ class PosixSerial(SerialBase):
             raise
         else:
             self._isOpen = True
+            if FileIO is not None:
+                self._fileio = FileIO(self.fd, 'r', closefd=False)
         self.flushInput()
 
 
@@ -412,6 +439,12 @@ class PosixSerial(SerialBase):
             else:
                 cflag &= ~(TERMIOS.CNEW_RTSCTS)
         # XXX should there be a warning if setting up rtscts (and xonxoff etc) fails??
+        # hang up (drop DTR/RTS) on close
+        if self._hupcl is not None:
+            if self._hupcl:
+                cflag |=  (TERMIOS.HUPCL)
+            else:
+                cflag &= ~(TERMIOS.HUPCL)
 
         # buffer
         # vmin "minimal number of characters to be read. = for non blocking"
@@ -433,6 +466,9 @@ class PosixSerial(SerialBase):
     def close(self):
         """Close port"""
         if self._isOpen:
+            if self._fileio is not None:
+                self._fileio.close()    # leaves the fd open
+                self._fileio = None
             if self.fd is not None:
                 os.close(self.fd)
                 self.fd = None
@@ -455,7 +491,17 @@ class PosixSerial(SerialBase):
            return less characters as requested. With no timeout it will block
            until the requested number of bytes is read."""
         if not self._isOpen: raise portNotOpenError
-        read = bytearray()
+        # the port is non-blocking, so whatever is already waiting can be
+        # read right away. when that covers the request no select is needed.
+        try:
+            buf = os.read(self.fd, size)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise SerialException('read failed: %s' % (e,))
+            buf = bytes()
+        if len(buf) == size:
+            return buf
+        read = bytearray(buf)
         while len(read) < size:
             try:
                 ready,_,_ = select.select([self.fd],[],[], self._timeout)
@@ -485,37 +531,106 @@ class PosixSerial(SerialBase):
                     raise SerialException('read failed: %s' % (e,))
         return bytes(read)
 
+    def _readWaiting(self, view):
+        """Read what is waiting, up to len(view) bytes, into view without
+           blocking. Returns the number of bytes read."""
+        try:
+            return self._fileio.readinto(view) or 0     # None: would block
+        except (IOError, OSError), e:
+            if e.errno != errno.EAGAIN:
+                raise SerialException('read failed: %s' % (e,))
+            return 0
+
+    def _readView(self, b):
+        """A memoryview on b for readinto to read into, or None if it has to
+           fall back on read and copy"""
+        if self._fileio is None:
+            return None
+        try:
+            return memoryview(b)
+        except TypeError:
+            return None     # e.g. array.array, which has no new style buffer in Python 2
+
+    def readinto(self, b):
+        """Read up to len(b) bytes from the serial port straight into b (a
+           bytearray, memoryview or other writable buffer) and return the
+           number of bytes read. Waits for data the same way read does, so
+           with a timeout it may return less than len(b)."""
+        if not self._isOpen: raise portNotOpenError
+        view = self._readView(b)
+        if view is None:
+            return SerialBase.readinto(self, b)
+        size = len(view)
+        # first take what is already waiting, like read does
+        n = self._readWaiting(view)
+        while n < size:
+            try:
+                ready,_,_ = select.select([self.fd],[],[], self._timeout)
+                if not ready:
+                    break   # timeout
+                got = self._fileio.readinto(view[n:])
+            except select.error, e:
+                if e[0] != errno.EAGAIN:
+                    raise SerialException('read failed: %s' % (e,))
+                continue
+            except (IOError, OSError), e:
+                if e.errno != errno.EAGAIN:
+                    raise SerialException('read failed: %s' % (e,))
+                continue
+            if got == 0:
+                # see read
+                raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
+            n += got or 0
+        return n
+
     def write(self, data):
         """Output the given string over the serial port."""
         if not self._isOpen: raise portNotOpenError
         d = to_bytes(data)
         tx_len = len(d)
-        if self._writeTimeout is not None and self._writeTimeout > 0:
-            timeout = time.time() + self._writeTimeout
-        else:
-            timeout = None
+        # the timeout covers the whole call, not just the waits
+        timeout = self._writeTimeout
+        if timeout is not None and timeout > 0:
+            deadline = time.time() + timeout
         while tx_len > 0:
             try:
                 n = os.write(self.fd, d)
-                if timeout:
-                    # when timeout is set, use select to wait for being ready
-                    # with the time left as timeout
-                    timeleft = timeout - time.time()
-                    if timeleft < 0:
-                        raise writeTimeoutError
-                    _, ready, _ = select.select([], [self.fd], [], timeleft)
-                    if not ready:
-                        raise writeTimeoutError
-                else:
-                    # wait for write operation
-                    _, ready, _ = select.select([], [self.fd], [], None)
-                    if not ready:
-                        raise SerialException('write failed (select)')
-                d = d[n:]
-                tx_len -= n
             except OSError, v:
                 if v.errno != errno.EAGAIN:
                     raise SerialException('write failed: %s' % (v,))
+                n = 0
+            tx_len -= n
+            if tx_len <= 0:
+                break   # all written, no need to wait
+            # partial write (or EAGAIN): the output buffer is full. continue
+            # with what's left, through a memoryview so it isn't copied
+            if n:
+                try:
+                    d = memoryview(d)[n:]
+                except TypeError:
+                    d = d[n:]       # no memoryview before Python 2.7
+            if timeout is not None and timeout > 0:
+                # when timeout is set, use select to wait for being ready
+                # with the time left as timeout
+                timeleft = deadline - time.time()
+                if timeleft < 0:
+                    raise writeTimeoutError
+                _, ready, _ = select.select([], [self.fd], [], timeleft)
+                if not ready:
+                    raise writeTimeoutError
+            else:
+                # wait for write operation
+                _, ready, _ = select.select([], [self.fd], [], None)
+                if not ready:
+                    raise SerialException('write failed (select)')
+        return len(data)
+
+    def writev(self, buffers):
+        """Output several strings (e.g. pre-encoded commands) over the serial
+           port, gathered into a single write. Returns the number of bytes
+           written."""
+        data = bytes().join([to_bytes(b) for b in buffers])
+        self.write(data)
         return len(data)
 
     def flush(self):
@@ -640,47 +755,148 @@ class PosixSerial(SerialBase):
 
 # assemble Serial class with the platform specifc implementation and the base
 # for file-like behavior. for Python 2.6 and newer, that provide the new I/O
-# library, derrive from io.RawIOBase
+# library, derrive from io.RawIOBase. ReceiveBuffer goes first so that its
+# readline (and read, which has to see what readline left in the buffer) are
+# used instead of the one byte at a time versions of the base.
 try:
     import io
 except ImportError:
     # classic version with our own file-like emulation
-    class Serial(PosixSerial, FileLike):
+    class Serial(ReceiveBuffer, PosixSerial, FileLike):
         pass
 else:
     # io library present
-    class Serial(PosixSerial, io.RawIOBase):
+    class Serial(ReceiveBuffer, PosixSerial, io.RawIOBase):
         pass
 
 class PosixPollSerial(Serial):
     """poll based read implementation. not all systems support poll properly.
     however this one has better handling of errors, such as a device
-    disconnecting while it's in use (e.g. USB-serial unplugged)"""
+    disconnecting while it's in use (e.g. USB-serial unplugged)
 
-    def read(self, size=1):
+    The port is registered once, when it's opened, with epoll where there is
+    one (Linux) and poll otherwise, so a read only has to wait. A hang up or
+    error on the device ends the wait at once with a SerialException."""
+
+    _epoll = None       # epoll object the open port is registered with (None with poll)
+    _pollWait = None    # the poll method of the epoll or poll object
+    _pollScale = 1      # its timeout unit: seconds for epoll, milliseconds for poll
+    _pollForever = None # its timeout to wait forever
+    _pollErrors = 0     # events that mean the device has gone
+
+    def open(self):
+        super(PosixPollSerial, self).open()
+        try:
+            if hasattr(select, 'epoll'):
+                self._epoll = select.epoll(1)
+                self._epoll.register(self.fd, select.EPOLLIN|select.EPOLLERR|select.EPOLLHUP)
+                self._pollWait = self._epoll.poll
+                self._pollScale, self._pollForever = 1, -1
+                self._pollErrors = select.EPOLLERR|select.EPOLLHUP
+            else:
+                poll = select.poll()
+                poll.register(self.fd, select.POLLIN|select.POLLERR|select.POLLHUP|select.POLLNVAL)
+                self._pollWait = poll.poll
+                self._pollScale, self._pollForever = 1000, None
+                self._pollErrors = select.POLLERR|select.POLLHUP|select.POLLNVAL
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        """Close port"""
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        self._pollWait = None
+        super(PosixPollSerial, self).close()
+
+    def _waitReadable(self, more=False):
+        """Wait (up to the timeout) for data to read. more is True once some
+           of the data has been read, when interCharTimeout (if set) also
+           limits the wait. A signal interrupting the wait doesn't end it
+           early: it's resumed for the time left. Returns False on timeout,
+           raises SerialException if the device reports an error or hang up."""
+        timeout = self._timeout
+        if more and self._interCharTimeout is not None and (timeout is None or self._interCharTimeout < timeout):
+            timeout = self._interCharTimeout
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            try:
+                events = self._pollWait(self._pollForever if timeout is None else timeout * self._pollScale)
+                break
+            except (IOError, select.error), e:
+                if e.args[0] != errno.EINTR:
+                    raise SerialException('read failed: %s' % (e,))
+                if timeout is not None:
+                    timeout = max(0, deadline - time.time())
+        if events and events[0][1] & self._pollErrors:
+            # only the port is registered, so there's at most one event
+            raise SerialException('device reports error (poll)')
+        return bool(events)
+
+    def _readRaw(self, size=1):
         """Read size bytes from the serial port. If a timeout is set it may
            return less characters as requested. With no timeout it will block
            until the requested number of bytes is read."""
-        if self.fd is None: raise portNotOpenError
-        read = bytearray()
-        poll = select.poll()
-        poll.register(self.fd, select.POLLIN|select.POLLERR|select.POLLHUP|select.POLLNVAL)
-        if size > 0:
-            while len(read) < size:
-                # print "\tread(): size",size, "have", len(read)    #debug
-                # wait until device becomes ready to read (or something fails)
-                for fd, event in poll.poll(self._timeout*1000):
-                    if event & (select.POLLERR|select.POLLHUP|select.POLLNVAL):
-                        raise SerialException('device reports error (poll)')
-                    #  we don't care if it is select.POLLIN or timeout, that's
-                    #  handled below
+        if not self._isOpen: raise portNotOpenError
+        # no need to poll if what's already waiting covers the request
+        try:
+            buf = os.read(self.fd, size)
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise SerialException('read failed: %s' % (e,))
+            buf = bytes()
+        if len(buf) == size:
+            return buf
+        read = bytearray(buf)
+        while len(read) < size:
+            if not self._waitReadable(len(read) > 0):
+                break   # timeout
+            try:
                 buf = os.read(self.fd, size - len(read))
-                read.extend(buf)
-                if ((self._timeout is not None and self._timeout >= 0) or 
-                    (self._interCharTimeout is not None and self._interCharTimeout > 0)) and not buf:
-                    break   # early abort on timeout
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise SerialException('read failed: %s' % (e,))
+                continue
+            if not buf:
+                raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
+            read.extend(buf)
         return bytes(read)
 
+    def _readintoRaw(self, b):
+        """Read up to len(b) bytes from the serial port straight into b,
+           waiting with poll. See PosixSerial.readinto."""
+        if not self._isOpen: raise portNotOpenError
+        view = self._readView(b)
+        if view is None:
+            return SerialBase.readinto(self, b)
+        size = len(view)
+        n = self._readWaiting(view)
+        while n < size:
+            if not self._waitReadable(n > 0):
+                break   # timeout
+            try:
+                got = self._fileio.readinto(view[n:])
+            except (IOError, OSError), e:
+                if e.errno != errno.EAGAIN:
+                    raise SerialException('read failed: %s' % (e,))
+                continue
+            if got == 0:
+                raise SerialException('device reports readiness to read but returned no data (device disconnected or multiple access on port?)')
+            n += got or 0
+        return n
+
+
+# on Linux the poll based class, with its epoll registration made once per
+# open, is faster than building a select set on every read and notices an
+# unplugged device at once, so it's the one Serial (and serial_for_url) gives.
+# the select based class stays available as PosixSelectSerial.
+PosixSelectSerial = Serial
+if plat[:5] == 'linux' and hasattr(select, 'epoll'):
+    Serial = PosixPollSerial
+
 
 if __name__ == '__main__':
     s = Serial(0,
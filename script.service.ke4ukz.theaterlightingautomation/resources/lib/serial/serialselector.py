@@ -0,0 +1,289 @@
+#! python
+#
+# Python Serial Port Extension for Win32, Linux, BSD, Jython
+# see __init__.py
+#
+# This module services many ports from one thread: native POSIX serial ports
+# and socket:// ports are registered on one epoll (poll where there is no
+# epoll), data read from them is handed to callbacks, and data written to them
+# is queued per port and sent as each port can take it.
+#
+#   selector = SerialSelector()
+#   selector.register(port, readable=gotData, error=portFailed)
+#   threading.Thread(target=selector.loop).start()
+#   selector.write(port, 'list\n')
+#
+# (C) 2015 Jonathan Dean (ke4ukz@gmx.com)
+# this is distributed under a free software license, see license.txt
+
+import os, select, errno, fcntl, threading
+from collections import deque
+from serial.serialutil import *
+
+READ_SIZE = 4096        # most read from a port at a time
+
+
+class SelectorPort(object):
+    """A port registered with a SerialSelector: its callbacks and the data
+    waiting to be written to it."""
+
+    def __init__(self, port, fd, readable, writable, error):
+        self.port = port
+        self.fd = fd
+        self.readable = readable    # readable(port, data)
+        self.writable = writable    # writable(port): write queue has emptied
+        self.error = error          # error(port, exception): port unregistered
+        self.queue = deque()        # data waiting to be written, oldest first
+        self.armed = False          # registered for writability
+
+
+class SerialSelector(object):
+    """\
+    Wait on many ports at once and dispatch callbacks for them, so one thread
+    can service them all instead of a reader thread per port.
+
+    The ports have to be open, have a fileno() (PosixSerial and socket://
+    ports do) and be non-blocking, which they are once open. The selector
+    reads and writes the file descriptors directly, so once a port is
+    registered read from it only through the readable callback. Writes may
+    come from any thread; callbacks are called from the thread running
+    loop() or poll().
+
+    A port that fails (hang up, error, or end of file) is unregistered and its
+    error callback is called with a SerialException.
+    """
+
+    def __init__(self):
+        self._epoll = hasattr(select, 'epoll')
+        if self._epoll:
+            self._poller = select.epoll()
+            self._IN, self._OUT = select.EPOLLIN, select.EPOLLOUT
+            self._ERRORS = select.EPOLLERR|select.EPOLLHUP
+            self._scale, self._forever = 1, -1          # seconds, -1 to wait forever
+        else:
+            self._poller = select.poll()
+            self._IN, self._OUT = select.POLLIN, select.POLLOUT
+            self._ERRORS = select.POLLERR|select.POLLHUP|select.POLLNVAL
+            self._scale, self._forever = 1000, None     # milliseconds, None to wait forever
+        self._ports = {}            # port -> SelectorPort
+        self._fds = {}              # fd -> SelectorPort
+        self._lock = threading.Lock()
+        self._running = True        # until stop()
+        # a pipe to wake up the wait, for stop() and for poll, which (unlike
+        # epoll) doesn't see registrations changed while it's waiting
+        self._wakeRead, self._wakeWrite = os.pipe()
+        for fd in (self._wakeRead, self._wakeWrite):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._poller.register(self._wakeRead, self._IN)
+
+    def register(self, port, readable=None, writable=None, error=None):
+        """Start servicing an open port. readable(port, data) is called with
+           data as it arrives, writable(port) when all data written with
+           write() has gone out and error(port, exception) if the port fails."""
+        fd = port.fileno()
+        entry = SelectorPort(port, fd, readable, writable, error)
+        self._lock.acquire()
+        try:
+            if port in self._ports:
+                raise SerialException('port is already registered')
+            self._poller.register(fd, self._IN|self._ERRORS)
+            self._ports[port] = entry
+            self._fds[fd] = entry
+        finally:
+            self._lock.release()
+        self._changed()
+
+    def unregister(self, port):
+        """Stop servicing a port. Data still waiting to be written is dropped."""
+        self._lock.acquire()
+        try:
+            entry = self._ports.pop(port, None)
+            if entry is None:
+                return
+            del self._fds[entry.fd]
+            try:
+                self._poller.unregister(entry.fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass    # already closed
+        finally:
+            self._lock.release()
+        self._changed()
+
+    def ports(self):
+        """The ports being serviced."""
+        self._lock.acquire()
+        try:
+            return self._ports.keys()
+        finally:
+            self._lock.release()
+
+    def outWaiting(self, port):
+        """Number of bytes queued for a port that haven't been written yet."""
+        self._lock.acquire()
+        try:
+            return sum([len(data) for data in self._ports[port].queue])
+        finally:
+            self._lock.release()
+
+    def write(self, port, data):
+        """Write data to a registered port without blocking. If the port
+           can't take all of it now, the rest is queued and sent by the
+           selector's thread as the port drains. Returns len(data)."""
+        d = to_bytes(data)
+        self._lock.acquire()
+        try:
+            entry = self._ports.get(port)
+            if entry is None:
+                raise SerialException('port is not registered')
+            if not entry.queue:
+                # nothing ahead of it, so try to get it out right away
+                n = self._send(entry, d)
+                if n == len(d):
+                    return len(data)
+                d = buffer(d, n)
+            entry.queue.append(d)
+            self._arm(entry, True)
+        finally:
+            self._lock.release()
+        return len(data)
+
+    def writev(self, port, buffers):
+        """Write several strings (e.g. pre-encoded commands) to a port as one
+           write. Returns the number of bytes written or queued."""
+        return self.write(port, bytes().join([to_bytes(b) for b in buffers]))
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (None: until something happens) for any
+           of the ports and call their callbacks. Returns the number of ports
+           that had something to do."""
+        try:
+            events = self._poller.poll(self._forever if timeout is None else timeout * self._scale)
+        except (IOError, select.error), e:
+            if e.args[0] == errno.EINTR:
+                return 0
+            raise
+        handled = 0
+        for fd, event in events:
+            if fd == self._wakeRead:
+                self._drainWake()
+                continue
+            entry = self._fds.get(fd)
+            if entry is None:
+                continue    # unregistered by an earlier callback
+            handled += 1
+            if event & self._IN and not self._read(entry):
+                continue
+            if event & self._ERRORS:
+                self._fail(entry, SerialException('device reports error (poll)'))
+                continue
+            if event & self._OUT:
+                self._flush(entry)
+        return handled
+
+    def loop(self):
+        """Service the ports until stop() is called."""
+        while self._running:
+            self.poll()
+
+    def stop(self):
+        """Make loop() return (from any thread)."""
+        self._running = False
+        self._wake()
+
+    def close(self):
+        """Unregister every port (the ports stay open) and release the selector."""
+        for port in self.ports():
+            self.unregister(port)
+        self._poller.unregister(self._wakeRead)
+        if self._epoll:
+            self._poller.close()
+        os.close(self._wakeRead)
+        os.close(self._wakeWrite)
+
+    #  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -  -
+
+    def _wake(self):
+        """Interrupt a wait in progress."""
+        try:
+            os.write(self._wakeWrite, b'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise   # EAGAIN: the pipe is full, so it's awake already
+
+    def _changed(self):
+        """Registrations have changed; make sure a wait in progress sees it."""
+        if not self._epoll:
+            self._wake()
+
+    def _drainWake(self):
+        try:
+            while os.read(self._wakeRead, 512):
+                pass
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def _arm(self, entry, writable):
+        """Register (or stop registering) a port for writability, called
+           with the lock held."""
+        if entry.armed != writable:
+            entry.armed = writable
+            self._poller.modify(entry.fd, self._IN|self._ERRORS|(writable and self._OUT or 0))
+            self._changed()
+
+    def _send(self, entry, data):
+        """Write what the port can take now. Returns the number of bytes written."""
+        try:
+            return os.write(entry.fd, data)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return 0
+            raise SerialException('write failed: %s' % (e,))
+
+    def _read(self, entry):
+        """Read what's waiting on a port and hand it to the readable callback.
+           Returns False if the port failed."""
+        try:
+            data = os.read(entry.fd, READ_SIZE)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return True
+            self._fail(entry, SerialException('read failed: %s' % (e,)))
+            return False
+        if not data:
+            self._fail(entry, SerialException('device reports readiness to read but returned no data (device disconnected?)'))
+            return False
+        if entry.readable is not None:
+            entry.readable(entry.port, data)
+        return True
+
+    def _flush(self, entry):
+        """Write as much of a port's queue as it can take."""
+        self._lock.acquire()
+        try:
+            if self._fds.get(entry.fd) is not entry:
+                return      # unregistered meanwhile
+            try:
+                while entry.queue:
+                    data = entry.queue[0]
+                    n = self._send(entry, data)
+                    if n < len(data):
+                        entry.queue[0] = buffer(data, n)
+                        return
+                    entry.queue.popleft()
+            except SerialException, e:
+                failure = e
+            else:
+                failure = None
+                self._arm(entry, False)
+        finally:
+            self._lock.release()
+        if failure is not None:
+            self._fail(entry, failure)
+        elif entry.writable is not None:
+            entry.writable(entry.port)
+
+    def _fail(self, entry, exception):
+        self.unregister(entry.port)
+        if entry.error is not None:
+            entry.error(entry.port, exception)
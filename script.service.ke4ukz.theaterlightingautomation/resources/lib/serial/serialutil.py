@@ -218,6 +218,139 @@ class FileLike(object):
         return False
 
 
+class ReceiveBuffer(object):
+    """Mix-in that gives a Serial class a receive buffer.
+
+    readline, readlines and xreadlines take whatever the port has waiting
+    in one read instead of calling read(1) for every byte, and look for
+    the end of line with find. Bytes received past the end of a line are
+    kept in the buffer, and read, inWaiting and flushInput take them into
+    account, so reading lines and reading bytes can be mixed.
+
+    It has to come before the platform class in the bases, e.g.
+    class Serial(ReceiveBuffer, PosixSerial, io.RawIOBase). Classes with
+    their own read implementation override _readRaw (and _readintoRaw)
+    instead of read (and readinto).
+
+    Timeouts work as with FileLike.readline: the timeout applies to each
+    wait for more data, and a line that times out is returned as far as
+    it got.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._rxbuffer = bytearray()
+        super(ReceiveBuffer, self).__init__(*args, **kwargs)
+
+    def open(self):
+        del self._rxbuffer[:]
+        super(ReceiveBuffer, self).open()
+
+    def close(self):
+        del self._rxbuffer[:]
+        super(ReceiveBuffer, self).close()
+
+    def _readRaw(self, size=1):
+        """read from the port itself, bypassing the buffer"""
+        return super(ReceiveBuffer, self).read(size)
+
+    def _fill(self):
+        """read what the port has waiting (waiting up to the timeout for at
+        least one byte) into the buffer. returns the number of bytes read,
+        0 on timeout."""
+        data = self._readRaw(max(1, super(ReceiveBuffer, self).inWaiting()))
+        self._rxbuffer.extend(data)
+        return len(data)
+
+    def _take(self, size):
+        """remove and return up to size bytes from the front of the buffer"""
+        data = bytes(self._rxbuffer[:size])
+        del self._rxbuffer[:size]
+        return data
+
+    def read(self, size=1):
+        if not self._rxbuffer:
+            return self._readRaw(size)
+        data = self._take(size)
+        if len(data) < size:
+            data += self._readRaw(size - len(data))
+        return data
+
+    def _readintoRaw(self, b):
+        """readinto from the port itself, bypassing the buffer"""
+        return super(ReceiveBuffer, self).readinto(b)
+
+    def readinto(self, b):
+        if not self._rxbuffer:
+            return self._readintoRaw(b)
+        try:
+            view = memoryview(b)
+        except TypeError:
+            # can't slice it to read the rest in; read copies it instead
+            return super(ReceiveBuffer, self).readinto(b)
+        n = min(len(view), len(self._rxbuffer))
+        view[:n] = self._take(n)
+        if n < len(view):
+            n += self._readintoRaw(view[n:])
+        return n
+
+    def inWaiting(self):
+        """Return the number of characters currently in the input buffer."""
+        return len(self._rxbuffer) + super(ReceiveBuffer, self).inWaiting()
+
+    def flushInput(self):
+        del self._rxbuffer[:]
+        super(ReceiveBuffer, self).flushInput()
+
+    def readline(self, size=None, eol=LF):
+        """read a line which is terminated with end-of-line (eol) character
+        ('\n' by default) or until timeout."""
+        if not self._isOpen: raise portNotOpenError
+        leneol = len(eol)
+        buf = self._rxbuffer
+        start = 0                   # where find picks up again after more data arrives
+        while True:
+            end = buf.find(eol, start)
+            if end >= 0:
+                end += leneol
+                break
+            if size is not None and len(buf) >= size:
+                end = size
+                break
+            # an eol split across two reads starts in the bytes already searched
+            start = max(0, len(buf) - leneol + 1)
+            if not self._fill():
+                end = len(buf)      # timeout
+                break
+        if size is not None:
+            end = min(end, size)
+        return self._take(end)
+
+    def readlines(self, sizehint=None, eol=LF):
+        """read a list of lines, until timeout.
+        sizehint is ignored."""
+        if self.timeout is None:
+            raise ValueError("Serial port MUST have enabled timeout for this function!")
+        leneol = len(eol)
+        lines = []
+        while True:
+            line = self.readline(eol=eol)
+            if line:
+                lines.append(line)
+                if line[-leneol:] != eol:    # was the line received with a timeout?
+                    break
+            else:
+                break
+        return lines
+
+    def xreadlines(self, sizehint=None):
+        """Read lines, implemented as generator. It will raise StopIteration on
+        timeout (empty read). sizehint is ignored."""
+        while True:
+            line = self.readline()
+            if not line: break
+            yield line
+
+
 class SerialBase(object):
     """Serial port base class. Provides __init__ function and properties to
        get/set port settings."""
@@ -242,7 +242,15 @@ class SocketSerial(SerialBase):
         return True
 
     # - - - platform specific - - -
-    # None so far
+
+    def fileno(self):
+        """\
+        The socket's file descriptor, for use with select (e.g. by
+        serialselector.SerialSelector). The socket has a timeout, which makes
+        it non-blocking at the OS level.
+        """
+        if not self._isOpen: raise portNotOpenError
+        return self._socket.fileno()
 
 
 # assemble Serial class with the platform specific implementation and the base
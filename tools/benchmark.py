@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Event-to-wire latency benchmark for the add-on.
+
+Runs addon.py headless (see kodidriver.py) and sends it the same cycle of events over and over:
+play, pause, screensaver, wake, resume, settings change, blackout start, blackout end, stop.
+For each event it times from the moment the callback is entered to the moment the last of the
+bytes it causes comes back out of Serial.write, and counts the bytes, writes and system calls
+made by the serial library on the way. The blackout period is started and ended by moving the
+add-on's clock to just before it starts or ends and letting its blackout scheduler fire, timed
+from the moment it starts or ends.
+
+	python tools/benchmark.py --port pty --iterations 100 --json results.json
+
+Ports:
+	lightfader	the emulated Arduino (lightfader:// URL, no system calls at all)
+	loop		pySerial's loop:// (also no system calls)
+	pty		the native serial class on a pseudo-terminal, with the emulated Arduino on the other end
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import threading
+
+import kodidriver
+from kodidriver import xbmc
+
+libPath = os.path.join(kodidriver.defaultAddonPath, "resources", "lib")
+
+#Events in the order they are sent each iteration; each one changes the lights
+EVENTS = ["play", "pause", "screensaver", "wake", "resume", "settings", "blackout", "daylight", "stop"]
+BLACKOUT_START = 12 * 60 #minutes past midnight the blackout period starts and ends on the add-on's clock
+BLACKOUT_END = 12 * 60 + 1
+SCHEDULER_LEAD = 0.1 #seconds before the start or end the clock is moved to, so the scheduler is waiting for it as it would be
+
+class WriteRecorder(object):
+	"""Wraps a serial port's write() to record when each write starts and returns, and how much it wrote"""
+	def __init__(self):
+		self.writes = [] #(start, end, bytes)
+		self.port = None
+
+	def attach(self, port):
+		"""Start recording writes to port (again if the add-on has replaced its port object)"""
+		if port is self.port:
+			return
+		self.port = port
+		write = port.write
+		def recordedWrite(data):
+			start = time.time()
+			try:
+				return write(data)
+			finally:
+				self.writes.append((start, time.time(), len(data)))
+		port.write = recordedWrite
+
+	def take(self):
+		"""Return and forget the writes recorded so far"""
+		writes, self.writes = self.writes, []
+		return writes
+
+class SyscallCounter(object):
+	"""Stands in for a module (os, select, fcntl, termios) inside serialposix and counts calls to its builtins"""
+	def __init__(self, module):
+		self.module = module
+		self.count = 0
+
+	def __getattr__(self, name):
+		value = getattr(self.module, name)
+		if isinstance(value, types.BuiltinFunctionType):
+			def counted(*args, **kwargs):
+				self.count += 1
+				return value(*args, **kwargs)
+			return counted
+		return value
+
+def countSyscalls(serialposix):
+	"""Make serialposix count the system calls it makes. Returns a function giving the total so far."""
+	counters = []
+	for name in ("os", "select", "fcntl", "termios"):
+		counter = SyscallCounter(getattr(serialposix, name))
+		setattr(serialposix, name, counter)
+		counters.append(counter)
+	return lambda: sum(counter.count for counter in counters)
+
+class ShiftedClock(object):
+	"""Stands in for the time module inside the add-on, with a clock that can be moved forward"""
+	def __init__(self, module):
+		self.module = module
+		self.offset = 0.0 #seconds the add-on's clock is ahead of the real one
+
+	def time(self):
+		return self.module.time() + self.offset
+
+	def __getattr__(self, name):
+		return getattr(self.module, name)
+
+def nextLocalTime(now, minutes):
+	"""The first time after now (seconds since the epoch) that the local clock reads a number of minutes past midnight"""
+	local = time.localtime(now)
+	for day in range(3):
+		moment = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + day, minutes // 60, minutes % 60, 0, 0, 0, -1))
+		if moment > now:
+			return moment
+
+class PtyArduino(threading.Thread):
+	"""The emulated Arduino on the far end of a pseudo-terminal"""
+	def __init__(self, boottime):
+		threading.Thread.__init__(self, name="PtyArduino")
+		self.daemon = True
+		import pty
+		from lightfader import firmware
+		self.master, self.slave = pty.openpty()
+		self.device = firmware.LightFader(boottime=boottime)
+		self.device.reset(time.time() * 1000)
+		self.running = True
+
+	def portName(self):
+		return os.ttyname(self.slave)
+
+	def run(self):
+		import select
+		while self.running:
+			upcoming = self.device.nextEvent()
+			timeout = 0.05 if upcoming is None else min(0.05, max(0, upcoming / 1000 - time.time()))
+			readable, _, _ = select.select([self.master], [], [], timeout)
+			now = time.time() * 1000
+			self.device.run(now)
+			if readable:
+				try:
+					self.device.receive(os.read(self.master, 4096), now)
+				except OSError:
+					break
+			data = self.device.transmitted(now)
+			if data:
+				os.write(self.master, data)
+
+	def stop(self):
+		self.running = False
+		self.join(1)
+
+def portReady(addon):
+	"""Whether the add-on has opened the port, heard from the Arduino, and started sending commands"""
+	return addon["portIsOpen"]() and ("port open" in addon["startupTimes"]) and not addon["serialWriter"].paused
+
+#names in xbmc.callbackLog of the add-on's own handlers, as opposed to other threads' Monitors hearing the same event
+HANDLER_PREFIXES = ("MonitorHandler.", "AutomationHandler.")
+
+def handlerEntered(entries):
+	"""The time the first of the add-on's handlers among callbackLog entries was entered, or None"""
+	for name, posted, started, finished in entries:
+		if name.startswith(HANDLER_PREFIXES):
+			return started
+	return None
+
+def moveClock(addon, clock, moment):
+	"""Move the add-on's clock forward to a moment, and have its blackout scheduler work the schedule out again
+	(as it does every BLACKOUT_RECHECK seconds in case the clock changes)
+	"""
+	clock.offset = moment - time.time()
+	addon["blackoutScheduler"].reschedule()
+
+def waitUntil(condition, message, timeout=10):
+	"""Wait for condition() to be true, raising RuntimeError with message if it isn't within timeout seconds"""
+	endtime = time.time() + timeout
+	while not condition():
+		if time.time() > endtime:
+			raise RuntimeError(message)
+		time.sleep(0.001)
+
+def percentile(values, fraction):
+	"""Nearest-rank percentile of a list of numbers"""
+	values = sorted(values)
+	if not values:
+		return None
+	index = max(0, min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1))
+	return values[index]
+
+def summarize(samples):
+	"""Turn a list of (latency, bytes, writes, syscalls) into statistics"""
+	latencies = [sample[0] * 1000 for sample in samples if sample[0] is not None]
+	count = float(len(samples)) or 1.0
+	return {
+		"transitions": len(samples),
+		"silent": len(samples) - len(latencies), #events that didn't write anything
+		"latency_ms": {
+			"p50": percentile(latencies, 0.5),
+			"p99": percentile(latencies, 0.99),
+			"max": max(latencies) if latencies else None,
+		},
+		"bytes_per_transition": sum(sample[1] for sample in samples) / count,
+		"writes_per_transition": sum(sample[2] for sample in samples) / count,
+		"syscalls_per_transition": sum(sample[3] for sample in samples) / count,
+	}
+
+def runBenchmark(portKind="lightfader", iterations=50, boottime=100, interval=0.005):
+	"""Run the benchmark and return the results as a dict"""
+	if libPath not in sys.path:
+		sys.path.append(libPath)
+	arduino = None
+	if portKind == "lightfader":
+		port = "lightfader://benchmark/boot=%d" % boottime
+	elif portKind == "loop":
+		port = "loop://"
+	elif portKind == "pty":
+		arduino = PtyArduino(boottime)
+		arduino.start()
+		port = arduino.portName()
+	else:
+		raise ValueError("unknown port type: " + portKind)
+
+	xbmc.CALLBACK_INTERVAL = interval
+	xbmc.logStream = None
+	driver = kodidriver.KodiDriver(settings={
+		"serialport": port,
+		"startblackouttime": "%02d:%02d" % divmod(BLACKOUT_START, 60), #the benchmark moves the add-on's clock to get there
+		"endblackouttime": "%02d:%02d" % divmod(BLACKOUT_END, 60),
+		"blackouthouse": True,
+		"blackoutaisle": True,
+		"blackoutambient": True,
+	})
+	if not driver.start(timeout=30):
+		raise RuntimeError("The add-on didn't start")
+	addon = driver.namespace
+	endtime = time.time() + 30
+	#the port is opened in the background, and nothing is written until the Arduino has answered and the writer is resumed
+	while not portReady(addon):
+		if time.time() > endtime:
+			driver.stop()
+			raise RuntimeError("The add-on didn't finish opening the serial port")
+		time.sleep(0.01)
+	clock = ShiftedClock(time)
+	addon["time"] = clock
+	moveClock(addon, clock, nextLocalTime(clock.time(), BLACKOUT_END) + 1) #start outside the blackout period
+	waitUntil(lambda: not addon["blackedOut"] and addon["sceneCoalescer"].settled(), "The add-on didn't end the blackout period")
+	serialposix = sys.modules.get("serial.serialposix")
+	syscalls = countSyscalls(serialposix) if serialposix is not None else (lambda: 0)
+	recorder = WriteRecorder()
+	recorder.attach(addon["serialPort"])
+	addon["serialWriter"].flush()
+	recorder.take()
+
+	samples = dict((event, []) for event in EVENTS)
+	playlevel = 0
+	try:
+		for iteration in range(iterations):
+			for event in EVENTS:
+				before = syscalls()
+				callbacks = len(xbmc.callbackLog)
+				entered = None
+				if event == "settings":
+					playlevel = 10 if playlevel == 0 else 0
+					driver.changeSettings(playhousebrightness=playlevel)
+				elif event in ("blackout", "daylight"):
+					#the scheduler changes the lights when the period starts or ends, so time from then
+					boundary = nextLocalTime(clock.time(), BLACKOUT_START if event == "blackout" else BLACKOUT_END)
+					moveClock(addon, clock, boundary - SCHEDULER_LEAD)
+					entered = boundary - clock.offset
+					waitUntil(lambda: addon["shownScene"] == addon["sceneState"](addon["currentMode"], event == "blackout"), "The blackout scheduler didn't fire")
+				else:
+					driver.runEvent(event)
+				driver.waitUntilIdle()
+				#events come seconds apart in use, so let the settle time pass rather than timing changes it holds back on purpose
+				while not addon["sceneCoalescer"].settled():
+					time.sleep(0.001)
+				addon["serialWriter"].flush()
+				recorder.attach(addon["serialPort"])
+				if entered is None:
+					entered = handlerEntered(xbmc.callbackLog[callbacks:])
+				writes = recorder.take()
+				latency = (writes[-1][1] - entered) if (writes and entered is not None) else None
+				samples[event].append((latency, sum(write[2] for write in writes), len(writes), syscalls() - before))
+	finally:
+		driver.stop()
+		if arduino is not None:
+			arduino.stop()
+
+	results = {
+		"port": portKind,
+		"iterations": iterations,
+		"events": dict((event, summarize(samples[event])) for event in EVENTS),
+		"overall": summarize([sample for event in EVENTS for sample in samples[event]]),
+	}
+	return results
+
+def formatResults(results):
+	"""Format the results as a table"""
+	lines = ["%-12s %9s %9s %9s %8s %7s %9s" % ("event", "p50 ms", "p99 ms", "max ms", "bytes", "writes", "syscalls")]
+	def row(name, stats):
+		latency = stats["latency_ms"]
+		numbers = [("%9.3f" % latency[key]) if latency[key] is not None else "%9s" % "-" for key in ("p50", "p99", "max")]
+		lines.append("%-12s %s %8.1f %7.2f %9.2f" % (name, " ".join(numbers), stats["bytes_per_transition"], stats["writes_per_transition"], stats["syscalls_per_transition"]))
+	for event in EVENTS:
+		row(event, results["events"][event])
+	row("overall", results["overall"])
+	return "\n".join(lines)
+
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(description="Measure how long the add-on takes to get each lighting change onto the wire")
+	parser.add_argument("--port", choices=["lightfader", "loop", "pty"], default="lightfader", help="what to connect the add-on to")
+	parser.add_argument("--iterations", type=int, default=50, help="times to go through the cycle of events")
+	parser.add_argument("--boot", type=int, default=100, help="emulated Arduino's boot time in milliseconds")
+	parser.add_argument("--json", metavar="FILE", help="also write the results as JSON to FILE (- for stdout)")
+	args = parser.parse_args(argv)
+
+	results = runBenchmark(args.port, args.iterations, args.boot)
+	if args.json == "-":
+		json.dump(results, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write("\n")
+	else:
+		sys.stdout.write(formatResults(results) + "\n")
+		if args.json:
+			with open(args.json, "w") as output:
+				json.dump(results, output, indent=2, sort_keys=True)
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
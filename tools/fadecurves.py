@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Compare the LightFader's fade curves without a board, using the add-on's fade tables.
+
+	python tools/fadecurves.py --from 0 --to 255 --duration 2000 --step 100
+	python tools/fadecurves.py --from 255 --to 0 --csv curves.csv
+	python tools/fadecurves.py --check 200
+
+Prints the level each curve (linear, exponential, logarithmic) has reached every --step milliseconds,
+and how far the exponential and logarithmic curves are from a straight line. --csv writes every
+millisecond instead. --check compares the tables with a step-by-step run of the firmware model
+for that many random fades.
+"""
+
+import os
+import sys
+import random
+
+toolsPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(os.path.dirname(toolsPath), "script.service.ke4ukz.theaterlightingautomation", "resources", "lib"))
+
+from lightfader import curves, firmware, tables
+
+MODES = [("linear", curves.FADE_LINEAR), ("exponential", curves.FADE_EXPONENTIAL), ("logarithmic", curves.FADE_LOGARITHMIC)]
+
+def curveTables(start, end, duration):
+	"""The table for each kind of fade between two levels"""
+	return [(name, tables.fadeTable(mode, start, end, duration)) for name, mode in MODES]
+
+def formatComparison(start, end, duration, step):
+	"""A table of the level of each curve every step milliseconds, and how far each strays from linear"""
+	curvetables = curveTables(start, end, duration)
+	lines = ["%8s %12s %12s %12s" % ("ms", "linear", "exponential", "logarithmic")]
+	times = list(range(0, duration, step)) + [duration]
+	for x in times:
+		lines.append("%8d %12d %12d %12d" % ((x,) + tuple([int(table[x]) for name, table in curvetables])))
+	linear = curvetables[0][1]
+	for name, table in curvetables[1:]:
+		differences = [abs(int(table[x]) - int(linear[x])) for x in range(duration + 1)]
+		lines.append("%s: mean %.1f, largest %d levels from linear" % (name, sum(differences) / float(len(differences)), max(differences)))
+	return "\n".join(lines)
+
+def writeCSV(path, start, end, duration):
+	"""Write the level of each curve at every millisecond"""
+	curvetables = curveTables(start, end, duration)
+	with open(path, "w") as output:
+		output.write("ms," + ",".join([name for name, table in curvetables]) + "\n")
+		for x in range(duration + 1):
+			output.write("%d,%s\n" % (x, ",".join([str(int(table[x])) for name, table in curvetables])))
+
+def checkTables(count, seed=1):
+	"""Run count random fades through the firmware model and compare every step with the tables.
+	Returns the number of steps that didn't match.
+	"""
+	generator = random.Random(seed)
+	mismatches = 0
+	for i in range(count):
+		name, mode = generator.choice(MODES)
+		start, end, duration = generator.randint(0, 255), generator.randint(0, 255), generator.randint(1, 3000)
+		board = firmware.LightFader(boottime=0, commandtime=0)
+		board.reset(0)
+		board.run(1)
+		board.processCommand("%s 0,%d,%d,%d" % (name, start, end, duration))
+		starttime = board.millis()
+		table = tables.fadeTable(mode, start, end, duration)
+		for x in range(1, duration + 1):
+			board.run(starttime + x + 0.5)
+			if board.values[0] != table[x]:
+				mismatches += 1
+				if mismatches <= 10:
+					sys.stdout.write("%s %d,%d,%d at %d ms: board %d, table %d\n" % (name, start, end, duration, x, board.values[0], table[x]))
+	return mismatches
+
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(description="Compare the LightFader's fade curves")
+	parser.add_argument("--from", dest="start", type=int, default=0, help="PWM level to fade from (default 0)")
+	parser.add_argument("--to", dest="end", type=int, default=255, help="PWM level to fade to (default 255)")
+	parser.add_argument("--duration", type=int, default=2000, help="fade time in milliseconds (default 2000)")
+	parser.add_argument("--step", type=int, default=100, help="milliseconds between the rows printed (default 100)")
+	parser.add_argument("--csv", metavar="FILE", help="write every millisecond of every curve to FILE instead")
+	parser.add_argument("--check", type=int, metavar="COUNT", help="check the tables against the firmware model for COUNT random fades")
+	args = parser.parse_args(argv)
+
+	if args.check:
+		mismatches = checkTables(args.check)
+		sys.stdout.write("%d fades checked (%s), %d mismatched steps\n" % (args.check, "NumPy" if tables.loadNumpy() is not None else "pure Python", mismatches))
+		return 1 if mismatches else 0
+	if args.csv:
+		writeCSV(args.csv, args.start, args.end, args.duration)
+	else:
+		sys.stdout.write(formatComparison(args.start, args.end, args.duration, max(args.step, 1)) + "\n")
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Run the add-on outside Kodi (using the stubs in kodistub/) and feed it a sequence of events.
+
+	python tools/kodidriver.py --set serialport=lightfader:// play sleep:3 pause sleep:1 resume stop
+
+Events: play, pause, resume, stop, end, screensaver, wake, set:<id>=<value>, sleep:<seconds>
+At the end the add-on is told Kodi is shutting down, and how long each callback took (and waited to
+be run) is printed along with the CPU time used.
+"""
+
+import os
+import sys
+import time
+import threading
+
+toolsPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(toolsPath, "kodistub"))
+
+import xbmc
+import xbmcaddon
+import xbmcgui
+
+defaultAddonPath = os.path.join(os.path.dirname(toolsPath), "script.service.ke4ukz.theaterlightingautomation")
+
+class KodiDriver(object):
+	"""Runs addon.py on its own thread the way Kodi runs a service, and plays the part of Kodi around it"""
+	def __init__(self, addonPath=defaultAddonPath, settings=None):
+		xbmcaddon.setAddonPath(addonPath)
+		xbmcaddon.changeSettings(**(settings or {}))
+		self.addonPath = addonPath
+		self.namespace = {"__name__": "__main__", "__file__": os.path.join(addonPath, "addon.py")}
+		self.thread = None
+
+	def start(self, timeout=10):
+		"""Start the add-on and wait (up to timeout seconds) for it to settle into its main loop"""
+		xbmc.abortEvent.clear()
+		self.thread = threading.Thread(target=self.runAddon, name="addon.py")
+		self.thread.daemon = True
+		self.thread.start()
+		return self.waitUntilIdle(timeout)
+
+	def runAddon(self):
+		"""Thread body: run addon.py like Kodi does"""
+		try:
+			with open(self.namespace["__file__"]) as source:
+				code = compile(source.read(), self.namespace["__file__"], "exec")
+			exec(code, self.namespace)
+		except SystemExit:
+			pass
+		except Exception:
+			import traceback
+			xbmc.log("EXCEPTION running add-on\n" + traceback.format_exc(), xbmc.LOGERROR)
+
+	def waitUntilIdle(self, timeout=10):
+		"""Wait until the add-on's thread is waiting in Kodi (and not in a callback) with no callbacks left to run"""
+		endtime = time.time() + timeout
+		with xbmc.callbackCondition:
+			while self.thread.is_alive() and ((xbmc.waitingThreads.get(self.thread) != 1) or xbmc.pendingCallbacks.get(self.thread) or xbmc.runningCallbacks.get(self.thread)):
+				remaining = endtime - time.time()
+				if remaining <= 0:
+					return False
+				xbmc.callbackCondition.wait(remaining)
+		return self.thread.is_alive()
+
+	def stop(self, timeout=10):
+		"""Tell the add-on Kodi is shutting down and wait for it to finish"""
+		xbmc.abort()
+		self.thread.join(timeout)
+		return not self.thread.is_alive()
+
+	def playerEvent(self, name):
+		"""Send a Player callback"""
+		xbmc.postCallback(name)
+
+	def monitorEvent(self, name):
+		"""Send a Monitor callback"""
+		xbmc.postCallback(name)
+
+	def play(self):
+		"""Start playing a video"""
+		for condition, value in (("Player.HasMedia", True), ("Player.HasVideo", True), ("Player.Playing", True), ("Player.Paused", False)):
+			xbmc.setCondition(condition, value)
+		self.playerEvent("onPlayBackStarted")
+
+	def pause(self):
+		"""Pause playback"""
+		xbmc.setCondition("Player.Playing", False)
+		xbmc.setCondition("Player.Paused", True)
+		self.playerEvent("onPlayBackPaused")
+
+	def resume(self):
+		"""Resume paused playback"""
+		xbmc.setCondition("Player.Paused", False)
+		xbmc.setCondition("Player.Playing", True)
+		self.playerEvent("onPlayBackResumed")
+
+	def stopPlayback(self, ended=False):
+		"""Stop playback (ended: the video got to the end rather than the user stopping it)"""
+		for condition in ("Player.HasMedia", "Player.HasVideo", "Player.Playing", "Player.Paused"):
+			xbmc.setCondition(condition, False)
+		self.playerEvent("onPlayBackEnded" if ended else "onPlayBackStopped")
+
+	def screensaver(self, active=True):
+		"""Turn the screensaver on or off"""
+		xbmc.setCondition("System.ScreenSaverActive", active)
+		self.monitorEvent("onScreensaverActivated" if active else "onScreensaverDeactivated")
+
+	def changeSettings(self, **values):
+		"""Change settings as if the user had done it in the settings dialog"""
+		xbmcaddon.changeSettings(**values)
+		self.monitorEvent("onSettingsChanged")
+
+	def runEvent(self, event):
+		"""Run one event from the command line syntax"""
+		if event.startswith("sleep:"):
+			time.sleep(float(event[len("sleep:"):]))
+		elif event.startswith("set:"):
+			key, _, value = event[len("set:"):].partition("=")
+			self.changeSettings(**{key: value})
+		elif event in ("play", "pause", "resume"):
+			getattr(self, event)()
+		elif event in ("stop", "end"):
+			self.stopPlayback(event == "end")
+		elif event in ("screensaver", "wake"):
+			self.screensaver(event == "screensaver")
+		else:
+			raise ValueError("unknown event: " + event)
+
+def callbackReport():
+	"""Summarize xbmc.callbackLog: how long each callback waited to be run and how long it took, in milliseconds"""
+	lines = []
+	for name, posted, started, finished in xbmc.callbackLog:
+		lines.append("%-45s waited %7.2f ms, ran %7.2f ms" % (name, (started - posted) * 1000, (finished - started) * 1000))
+	return "\n".join(lines)
+
+def main(argv):
+	import argparse
+	parser = argparse.ArgumentParser(description="Run the Theater Lighting Automation add-on outside Kodi")
+	parser.add_argument("--addon", default=defaultAddonPath, help="add-on folder (default: the one in this repository)")
+	parser.add_argument("--set", action="append", default=[], metavar="ID=VALUE", help="setting to change before starting")
+	parser.add_argument("--loglevel", type=int, default=xbmc.LOGDEBUG, help="lowest Kodi log level to show (0-7)")
+	parser.add_argument("--interval", type=float, default=xbmc.CALLBACK_INTERVAL, help="seconds between callback checks while waiting (Kodi uses 0.1)")
+	parser.add_argument("events", nargs="*", help="events to send, in order")
+	args = parser.parse_args(argv)
+
+	xbmc.logLevel = args.loglevel
+	xbmc.setCondition("System.GetBool(debug.showloginfo)", args.loglevel <= xbmc.LOGDEBUG)
+	xbmc.CALLBACK_INTERVAL = args.interval
+	settings = dict(setting.split("=", 1) for setting in args.set)
+	driver = KodiDriver(args.addon, settings)
+	cpu = os.times()
+	if not driver.start():
+		sys.stderr.write("The add-on didn't settle into its main loop\n")
+	for event in args.events:
+		driver.runEvent(event)
+		driver.waitUntilIdle()
+	driver.stop()
+	cpu = [after - before for before, after in zip(cpu, os.times())]
+	sys.stdout.write(callbackReport() + "\n")
+	sys.stdout.write("CPU time: %.3f s user, %.3f s system\n" % (cpu[0], cpu[1]))
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
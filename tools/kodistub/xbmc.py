@@ -0,0 +1,282 @@
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Stand-in for Kodi's xbmc module so add-ons can run headless (see kodidriver.py).
+
+Like Kodi, Player and Monitor callbacks are run on the thread that created the object,
+in between the slices of time it spends in sleep() or Monitor.waitForAbort().
+"""
+
+import os
+import sys
+import time
+import tempfile
+import threading
+import traceback
+import weakref
+
+#Log levels, with the values Kodi uses
+LOGDEBUG = 0
+LOGINFO = 1
+LOGNOTICE = 2
+LOGWARNING = 3
+LOGERROR = 4
+LOGSEVERE = 5
+LOGFATAL = 6
+LOGNONE = 7
+levelNames = ["DEBUG", "INFO", "NOTICE", "WARNING", "ERROR", "SEVERE", "FATAL", "NONE"]
+
+CALLBACK_INTERVAL = 0.1 #Kodi waits in slices of up to 100ms and runs pending callbacks between them
+
+logEntries = [] #(time, level, message) for everything logged at or above logLevel
+logLevel = LOGDEBUG
+logStream = sys.stdout #where log entries are echoed, or None
+conditions = {} #lowercase boolean condition name -> value, for getCondVisibility
+infoLabels = {} #info label name -> value, for getInfoLabel
+callbackLog = [] #(callback name, time posted, time started, time finished) for every callback run
+
+abortEvent = threading.Event()
+callbackCondition = threading.Condition()
+pendingCallbacks = {} #thread -> list of (name, function, args, time posted)
+runningCallbacks = {} #thread -> how many callbacks it is in the middle of running (one can sleep and run the next)
+waitingThreads = {} #thread -> how many sleep() or waitForAbort() calls it is in (callbacks can sleep too)
+callbackTargets = weakref.WeakValueDictionary() #id -> Player or Monitor that can receive callbacks
+
+def log(msg, level=LOGNOTICE):
+	"""Add an entry to the log"""
+	if level < logLevel:
+		return
+	now = time.time()
+	logEntries.append((now, level, msg))
+	if logStream is not None:
+		logStream.write("%s %7s: %s\n" % (time.strftime("%H:%M:%S", time.localtime(now)), levelNames[level], msg))
+
+def getCondVisibility(condition):
+	"""Evaluate a boolean condition: names joined with | (or) and + (and), optionally negated with !"""
+	for alternative in condition.split("|"):
+		if all(checkCondition(term) for term in alternative.split("+")):
+			return True
+	return False
+
+def checkCondition(term):
+	"""Look up one (possibly negated) condition"""
+	term = term.strip().lower()
+	if term.startswith("!"):
+		return not checkCondition(term[1:])
+	if term == "true":
+		return True
+	return bool(conditions.get(term, False))
+
+def setCondition(name, value=True):
+	"""Set what a boolean condition evaluates to (for drivers)"""
+	conditions[name.lower()] = value
+
+def getInfoLabel(label):
+	"""Look up an info label"""
+	return infoLabels.get(label, "")
+
+def translatePath(path):
+	"""Turn a special:// path into a real one under a scratch directory"""
+	if path.startswith("special://"):
+		special, _, rest = path[len("special://"):].partition("/")
+		return os.path.join(specialRoot, special, *rest.split("/"))
+	return path
+
+specialRoot = os.environ.get("KODI_HOME", os.path.join(tempfile.gettempdir(), "kodistub"))
+
+def executeJSONRPC(jsonrpccommand):
+	"""JSON-RPC isn't emulated; answer like Kodi does for an unknown method"""
+	return '{"error":{"code":-32601,"message":"Method not found."},"id":1,"jsonrpc":"2.0"}'
+
+def executebuiltin(function, wait=False):
+	"""Builtins are logged and otherwise ignored"""
+	log("executebuiltin: " + function, LOGDEBUG)
+
+def abortRequested():
+	return abortEvent.is_set()
+
+def sleep(time):
+	"""Sleep for time milliseconds, running pending callbacks"""
+	waitFor(time / 1000.0)
+
+def waitFor(timeout):
+	"""Wait until timeout seconds (None for no limit) pass or Kodi is shutting down, running pending callbacks
+	between slices of the wait like Kodi does. Returns True if Kodi is shutting down.
+	"""
+	thread = threading.current_thread()
+	endtime = None if timeout is None else (time.time() + timeout)
+	with callbackCondition:
+		waitingThreads[thread] = waitingThreads.get(thread, 0) + 1
+		callbackCondition.notifyAll()
+	try:
+		while True:
+			remaining = CALLBACK_INTERVAL if endtime is None else min(CALLBACK_INTERVAL, endtime - time.time())
+			if remaining > 0 and abortEvent.wait(remaining):
+				return True
+			runCallbacks(thread)
+			if abortEvent.is_set():
+				return True
+			if (endtime is not None) and (time.time() >= endtime):
+				return False
+	finally:
+		with callbackCondition:
+			if waitingThreads[thread] > 1:
+				waitingThreads[thread] -= 1
+			else:
+				del waitingThreads[thread]
+			callbackCondition.notifyAll()
+
+def runCallbacks(thread):
+	"""Run the callbacks waiting for a thread"""
+	while True:
+		with callbackCondition:
+			queue = pendingCallbacks.get(thread)
+			if not queue:
+				pendingCallbacks.pop(thread, None)
+				callbackCondition.notifyAll()
+				return
+			name, function, args, posted = queue.pop(0)
+			runningCallbacks[thread] = runningCallbacks.get(thread, 0) + 1
+		started = time.time()
+		try:
+			function(*args)
+		except Exception:
+			log("EXCEPTION in callback " + name + "\n" + traceback.format_exc(), LOGERROR)
+		callbackLog.append((name, posted, started, time.time()))
+		with callbackCondition:
+			if runningCallbacks[thread] > 1:
+				runningCallbacks[thread] -= 1
+			else:
+				del runningCallbacks[thread]
+			callbackCondition.notifyAll()
+
+def postCallback(name, *args):
+	"""Queue a callback on every Player or Monitor that handles it, to be run on the thread that created it"""
+	for target in list(callbackTargets.values()):
+		function = getattr(target, name, None)
+		if function is not None and handlesCallback(target, name):
+			postCall(target.ownerThread, type(target).__name__ + "." + name, function, *args)
+
+def handlesCallback(target, name):
+	"""Whether a Player or Monitor overrides a callback. The stub's own callbacks do nothing, and a plain Monitor
+	(made just for waitForAbort) often belongs to a thread that waits some other way and would never run them.
+	"""
+	for base in (Monitor, Player):
+		if isinstance(target, base):
+			return getattr(type(target), name, None) != getattr(base, name, None)
+	return True
+
+def postCall(thread, name, function, *args):
+	"""Queue any function to be run on a thread the next time it checks for callbacks (for drivers)"""
+	with callbackCondition:
+		pendingCallbacks.setdefault(thread, []).append((name, function, args, time.time()))
+		callbackCondition.notifyAll()
+
+def waitForCallbacks(timeout=None):
+	"""Wait until every queued callback has been run. Returns False on timeout."""
+	endtime = None if timeout is None else (time.time() + timeout)
+	with callbackCondition:
+		while any(thread.is_alive() for thread in list(pendingCallbacks) + list(runningCallbacks)):
+			remaining = None if endtime is None else (endtime - time.time())
+			if (remaining is not None) and (remaining <= 0):
+				return False
+			callbackCondition.wait(remaining)
+	return True
+
+def abort():
+	"""Tell everything Kodi is shutting down"""
+	postCallback("onAbortRequested")
+	abortEvent.set()
+
+class CallbackTarget(object):
+	"""Something Kodi can call back, remembered along with the thread that made it"""
+	def __init__(self):
+		self.ownerThread = threading.current_thread()
+		callbackTargets[id(self)] = self
+
+class Monitor(CallbackTarget):
+	"""Hears about settings changes, the screensaver, and Kodi shutting down"""
+	def __init__(self):
+		CallbackTarget.__init__(self)
+
+	def onSettingsChanged(self):
+		pass
+
+	def onScreensaverActivated(self):
+		pass
+
+	def onScreensaverDeactivated(self):
+		pass
+
+	def onDPMSActivated(self):
+		pass
+
+	def onDPMSDeactivated(self):
+		pass
+
+	def onAbortRequested(self):
+		pass
+
+	def onNotification(self, sender, method, data):
+		pass
+
+	def waitForAbort(self, timeout=None):
+		"""Wait for Kodi to shut down (up to timeout seconds). Returns True if it is."""
+		return waitFor(timeout)
+
+	def abortRequested(self):
+		return abortEvent.is_set()
+
+class Player(CallbackTarget):
+	"""Hears about playback starting, stopping, pausing and resuming"""
+	def __init__(self, playerCore=None):
+		CallbackTarget.__init__(self)
+
+	def onPlayBackStarted(self):
+		pass
+
+	def onPlayBackEnded(self):
+		pass
+
+	def onPlayBackStopped(self):
+		pass
+
+	def onPlayBackPaused(self):
+		pass
+
+	def onPlayBackResumed(self):
+		pass
+
+	def onQueueNextItem(self):
+		pass
+
+	def onPlayBackSpeedChanged(self, speed):
+		pass
+
+	def onPlayBackSeek(self, time, seekOffset):
+		pass
+
+	def onPlayBackSeekChapter(self, chapter):
+		pass
+
+	def isPlaying(self):
+		return getCondVisibility("Player.HasMedia")
+
+	def isPlayingVideo(self):
+		return getCondVisibility("Player.HasVideo")
+
+	def isPlayingAudio(self):
+		return getCondVisibility("Player.HasAudio")
@@ -0,0 +1,115 @@
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Stand-in for Kodi's xbmcaddon module, reading the add-on's own addon.xml, settings.xml and strings.xml"""
+
+import os
+import threading
+import xml.etree.ElementTree as ElementTree
+
+import xbmc
+
+addonPath = os.path.abspath(os.environ.get("KODI_ADDON_PATH", os.getcwd())) #folder holding addon.xml
+settingValues = {} #setting id -> string value, shared by every Addon object like Kodi does
+settingsLock = threading.Lock()
+settingsLoaded = [False]
+
+def setAddonPath(path):
+	"""Point the stub at a different add-on folder and forget any settings that were changed"""
+	global addonPath
+	addonPath = os.path.abspath(path)
+	with settingsLock:
+		settingValues.clear()
+		settingsLoaded[0] = False
+
+def loadDefaults():
+	"""Fill in every setting from the defaults in resources/settings.xml"""
+	with settingsLock:
+		if settingsLoaded[0]:
+			return
+		tree = ElementTree.parse(os.path.join(addonPath, "resources", "settings.xml"))
+		for setting in tree.iter("setting"):
+			if setting.get("id") is not None:
+				settingValues.setdefault(setting.get("id"), setting.get("default", ""))
+		settingsLoaded[0] = True
+
+def changeSettings(**values):
+	"""Change settings the way the user would in the settings dialog (for drivers; call onSettingsChanged afterwards)"""
+	loadDefaults()
+	with settingsLock:
+		for key, value in values.items():
+			if isinstance(value, bool):
+				value = "true" if value else "false"
+			settingValues[key] = str(value)
+
+class Addon(object):
+	"""Information and settings for the add-on"""
+	def __init__(self, id=None):
+		self.root = ElementTree.parse(os.path.join(addonPath, "addon.xml")).getroot()
+		self.id = id or self.root.get("id")
+		self.strings = None
+
+	def getSetting(self, id):
+		"""Get a setting as a string ("" if there is no such setting)"""
+		loadDefaults()
+		with settingsLock:
+			return settingValues.get(id, "")
+
+	def setSetting(self, id, value):
+		"""Change a setting"""
+		loadDefaults()
+		with settingsLock:
+			settingValues[id] = value
+
+	def openSettings(self):
+		xbmc.log("openSettings is not emulated", xbmc.LOGWARNING)
+
+	def getLocalizedString(self, id):
+		"""Get a string from resources/language/English/strings.xml ("" if there is no such string)"""
+		if self.strings is None:
+			self.strings = {}
+			path = os.path.join(addonPath, "resources", "language", "English", "strings.xml")
+			if os.path.exists(path):
+				for string in ElementTree.parse(path).getroot().iter("string"):
+					self.strings[int(string.get("id"))] = string.text or ""
+		return self.strings.get(int(id), "")
+
+	def getAddonInfo(self, id):
+		"""Get a piece of information about the add-on from addon.xml"""
+		if id in ("id", "name", "version"):
+			return self.root.get(id)
+		if id == "author":
+			return self.root.get("provider-name")
+		if id == "path":
+			return addonPath
+		if id == "profile":
+			return "special://profile/addon_data/" + self.id + "/"
+		if id == "icon":
+			return os.path.join(addonPath, "icon.png")
+		if id == "fanart":
+			return os.path.join(addonPath, "fanart.jpg")
+		if id == "changelog":
+			return os.path.join(addonPath, "changelog.txt")
+		if id == "type":
+			for extension in self.root.iter("extension"):
+				if extension.get("point") != "xbmc.addon.metadata":
+					return extension.get("point")
+			return ""
+		for extension in self.root.iter("extension"):
+			element = extension.find(id)
+			if element is not None:
+				return element.text or ""
+		return ""
@@ -0,0 +1,42 @@
+# Copyright 2015 Jonathan Dean (ke4ukz@gmx.com)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Stand-in for Kodi's xbmcgui module; dialogs are logged instead of shown"""
+
+import time
+
+import xbmc
+
+NOTIFICATION_INFO = "info"
+NOTIFICATION_WARNING = "warning"
+NOTIFICATION_ERROR = "error"
+
+notifications = [] #(time, heading, message, icon) for every notification shown
+timeNow = time.time #notification() has a parameter called time
+
+class Dialog(object):
+	"""Dialogs that answer as if the user dismissed them straight away"""
+	def notification(self, heading, message, icon=NOTIFICATION_INFO, time=5000, sound=True):
+		notifications.append((timeNow(), heading, message, icon))
+		xbmc.log("Notification (" + icon + "): " + heading + ": " + message, xbmc.LOGNOTICE)
+
+	def ok(self, heading, line1, line2="", line3=""):
+		xbmc.log("Dialog: " + heading + ": " + " ".join([line1, line2, line3]).strip(), xbmc.LOGNOTICE)
+		return True
+
+	def yesno(self, heading, line1, line2="", line3="", nolabel="", yeslabel="", autoclose=0):
+		xbmc.log("Yes/no dialog (answered no): " + heading + ": " + " ".join([line1, line2, line3]).strip(), xbmc.LOGNOTICE)
+		return False